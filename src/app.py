@@ -1,59 +1,233 @@
-import json
-
 from db import db
+import bulk
+import cache
+import click
 import dao
+import database
+import encoding
 from flask import Flask
+from flask import Request
+from flask import current_app
 from flask import request
-from db import Asset, User, Post, Comment, Tag
+from flask import send_from_directory
+from flask import stream_with_context
+from db import Asset, User, Post, Comment, Tag, UnknownTag, UnknownField
+from db import POST_FIELDS, POST_VIEWS, USER_FIELDS, USER_VIEWS, selectFields
+import ingredients
+import metrics
+import migrations
+from pagination import InvalidCursor, InvalidLimit, parseLimit
 import os
+import queryplans
+import storage
+import streaming
+import sys
+import timeline
+import uploads
+import zlib
+
+# /bulk/import/ reads its body line by line, so it may be larger than MAX_CONTENT_LENGTH
+class AppRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == "bulkImport":
+            return current_app.config["BULK_IMPORT_MAX_CONTENT_LENGTH"]
+        return super().max_content_length
 
 # can probably change the filename
 db_filename = "app.db"
 app = Flask(__name__)
+app.request_class = AppRequest
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
+# DATABASE_URL points the app at another database, e.g. the one benchmarks/seed.py fills
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///%s" % db_filename)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+# connection pool of the database and its replicas, also used for SQLite files, see database.py
+app.config["SQLALCHEMY_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 5))
+app.config["SQLALCHEMY_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+app.config["SQLALCHEMY_POOL_TIMEOUT"] = int(os.environ.get("DB_POOL_TIMEOUT", 30)) # seconds
+app.config["SQLALCHEMY_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", 1800)) # seconds
+# comma separated URLs of read replicas of DATABASE_URL, which serve the read-only dao functions, see replicas.py
+app.config["SQLALCHEMY_REPLICAS"] = [u.strip() for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+# logs every statement synchronously, for debugging only; /metrics counts and times them instead
+app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO", "false").lower() == "true"
+# per-route request, SQL and serialization stats for /metrics, see metrics.py
+app.config["METRICS"] = os.environ.get("METRICS", "true").lower() == "true"
+# precompute following feeds on write instead of joining on read, see timeline.py
+app.config["TIMELINE_FANOUT"] = os.environ.get("TIMELINE_FANOUT", "false").lower() == "true"
+# where images are stored: "s3", "local" (files under LOCAL_STORAGE_DIR) or "memory", see storage.py
+app.config["STORAGE_BACKEND"] = os.environ.get("STORAGE_BACKEND", "s3")
+app.config["S3_BUCKET"] = os.environ.get("S3_BUCKET", storage.S3_BUCKET)
+app.config["S3_BASE_URL"] = os.environ.get("S3_BASE_URL", f"https://{app.config['S3_BUCKET']}.s3-us-east-2.amazonaws.com")
+app.config["LOCAL_STORAGE_DIR"] = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(app.root_path, "images"))
+# read-through cache of the DAO reads: "local", "shared", "redis" (CACHE_REDIS_URL) or "none", see cache.py
+app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "local")
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+# largest request body, room for a streaming.MAX_IMAGE_BYTES image encoded in base64 for the legacy route
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+# largest body of /bulk/import/; the import-ndjson command reads files of any size
+app.config["BULK_IMPORT_MAX_CONTENT_LENGTH"] = int(os.environ.get("BULK_IMPORT_MAX_BYTES", 1024 * 1024 * 1024))
 
 db.init_app(app)
+database.init_app(app)
+metrics.init_app(app)
+storage.init_app(app)
+encoding.init_app(app)
+cache.init_app(app)
 with app.app_context():
-    db.create_all()
+    migrations.upgrade()
+    ingredients.indexAll() # indexes posts written before the ingredient index existed
+    uploads.failAbandoned()
 
 ########## HELPER FUNCTIONS #############
 def success_response(data, code=200):
-    return json.dumps({"success": True, "data": data}), code
+    return app.response_class(metrics.dumps({"success": True, "data": data}), status=code, mimetype="application/json")
 
 def failure_response(message, code=404):
-    return json.dumps({"success": False, "error": message}), code
+    return app.response_class(metrics.dumps({"success": False, "error": message}), status=code, mimetype="application/json")
+
+# ?limit=&after= switches a list route to keyset pagination; without either the full list is returned.
+# An invalid limit is a 400, see pagination.parseLimit.
+def page_args():
+    return {
+        "limit": parseLimit(request.args.get("limit")),
+        "after": request.args.get("after")
+    }
+
+# ?view=summary|full or ?fields=a,b picks the serialized post fields; the default is full
+def post_fields():
+    return {"fields": selectFields(POST_FIELDS, POST_VIEWS, request.args.get("view"), request.args.get("fields"))}
+
+# the same for users; ?view= also picks the fields of their embedded posts
+def user_fields():
+    view = request.args.get("view")
+    return {
+        "fields": selectFields(USER_FIELDS, USER_VIEWS, view, request.args.get("fields")),
+        "postFields": selectFields(POST_FIELDS, POST_VIEWS, view)
+    }
+
+# A weak ETag from the versions a response was built from and the query arguments that shape it
+# (view, fields, page, filters). Routes check it before loading anything, so a client that
+# already has the current version gets an empty 304.
+def etag(kind, *versions):
+    args = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    return f"{kind}-{'-'.join(map(str, versions))}-{zlib.crc32(args.encode()):08x}"
+
+def not_modified(tag):
+    return request.method == "GET" and request.if_none_match.contains_weak(tag)
+
+def conditional_response(tag, response=None):
+    if response is None:
+        response = app.response_class(status=304)
+    response.set_etag(tag, weak=True)
+    return response
+
+# the ids of a batch read body, {"ids": [...]}, or None when they are not a list of at most
+# dao.MAX_BATCH_SIZE integers
+def batch_ids():
+    ids = encoding.requestBody().get("ids")
+    if not isinstance(ids, list) or len(ids) > dao.MAX_BATCH_SIZE:
+        return None
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return None
+    return ids
+
+# only checks that a post exists, in read routes; write routes use dao.postExists and
+# dao.userExists, which read the primary
+EXISTS_POST = ("post_id",)
+
+@app.errorhandler(UnknownField)
+def unknown_field(e):
+    return failure_response(str(e), 400)
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    return failure_response(str(e), 400)
+
+@app.errorhandler(InvalidLimit)
+def invalid_limit(e):
+    return failure_response(str(e), 400)
+
+@app.errorhandler(UnknownTag)
+def unknown_tag(e):
+    return failure_response(str(e), 400)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    if request.endpoint == "bulkImport":
+        return failure_response("Request body is too large! Import large files with flask import-ndjson.", 413)
+    return failure_response("Request body is too large!", 413)
+
+# checks that the owner of an uploaded image exists; returns an error message or None
+def image_owner_error(imgType, typeId):
+    if imgType != "profile" and imgType != "post":
+        return imgType
+    if imgType == "profile":
+        user = User.query.filter_by(id=typeId).first()
+        if user is None:
+            return "This user does not exist!"
+    elif imgType == "post":
+        post = Post.query.filter_by(id=typeId).first()
+        if post is None:
+            return "This post does not exist!"
+    return None
 
 ########## ROUTES ##############
 
 # uploads an image to the bucket
-# somehow still uploads images to the bucket even if there is an error
 @app.route("/user/image/upload/", methods=["POST"])
 def upload_image():
-    body = json.loads(request.data)
+    body = encoding.requestBody()
     imageData = body.get("imageData")
     imgType = body.get("imgType")
     typeId = body.get("typeId")
     # no image data or image type
     if (imageData is None or imgType is None):
         return failure_response("No base64 URL to be found or no image type!")
-    # incorrect image type
-    if imgType != "profile" and imgType != "post":
-        return failure_response(imgType)    
-    if imgType == "profile":
-        user = User.query.filter_by(id=typeId).first()
-        if user is None:
-            return failure_response("This user does not exist!")
-    elif imgType == "post":
-        post = Post.query.filter_by(id=typeId).first()
-        if post is None:
-            return failure_response("This post does not exist!")
+    # incorrect image type or missing owner
+    error = image_owner_error(imgType, typeId)
+    if error is not None:
+        return failure_response(error)
     asset = dao.uploadImage(imageData=imageData, imgType=imgType, typeId=typeId)
     if asset is None:
         return failure_response("There was an error creating the asset!")
-    return success_response(asset, 201)
+    # accepted: the image is uploaded in the background, poll /image/<img_id>/ for its status
+    return success_response(asset, 202)
+
+STREAM_MIMETYPES = ("application/octet-stream", "multipart/form-data")
+
+# uploads an image sent as the raw request body (?imgType=&typeId=) or as the "image" file of a
+# multipart form; the body is streamed to a temporary file instead of being read into memory
+@app.route("/user/image/upload/stream/", methods=["POST"])
+def upload_image_stream():
+    # any other body, e.g. a form-urlencoded one, would be parsed as a form and lose the image
+    if not (request.mimetype in STREAM_MIMETYPES or request.mimetype.startswith("image/")):
+        return failure_response(f"Send the image as application/octet-stream, image/* or multipart/form-data, "
+            f"not {request.mimetype or 'a body without a Content-Type'}!", 415)
+    imgType = request.values.get("imgType")
+    typeId = request.values.get("typeId", type=int)
+    if imgType is None or typeId is None:
+        return failure_response("No image type or id!", 400)
+    if request.content_length is not None and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        return failure_response("Request body is too large!", 413)
+    if request.mimetype == "multipart/form-data":
+        if "image" not in request.files:
+            return failure_response("No image file to be found!", 400)
+        body = request.files["image"].stream
+    else:
+        body = request.stream
+    error = image_owner_error(imgType, typeId)
+    if error is not None:
+        return failure_response(error)
+    try:
+        image = streaming.read(body)
+    except streaming.ImageTooLarge as e:
+        return failure_response(str(e), 413)
+    except (ValueError, OSError, SyntaxError) as e:
+        return failure_response(f"Unable to create image due to {e}", 400)
+    asset = dao.uploadStreamedImage(image, imgType=imgType, typeId=typeId)
+    # accepted: the image is uploaded in the background, poll /image/<img_id>/ for its status
+    return success_response(asset, 202)
 
 
 @app.route("/image/<int:img_id>/")
@@ -63,6 +237,14 @@ def get_image(img_id):
         return failure_response("Image cannot be found!")
     return success_response(asset, 200)
 
+# serves images stored by the local storage backend during development
+@app.route("/images/<path:key>")
+def get_local_image(key):
+    backend = storage.current()
+    if not isinstance(backend, storage.LocalStorage):
+        return failure_response("Images are not served by this server!")
+    return send_from_directory(backend.root, key)
+
 @app.route("/image/<int:img_id>/delete/", methods=["DELETE"])
 def delete_image(img_id):
     asset = dao.deleteImage(img_id)
@@ -71,26 +253,50 @@ def delete_image(img_id):
     return success_response(asset)
     
 
+@app.route("/cache/stats/")
+def cacheStats():
+    return success_response(cache.current().stats())
+
+# Prometheus scrape endpoint, see metrics.py
+@app.route("/metrics")
+def getMetrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/getUsers/")
 def getUsers():
     #users = [u.serialize() for u in User.query.all()]
     #return success_response(users, 200)
-    return success_response(dao.getUsers())
+    return success_response(dao.getUsers(**page_args(), **user_fields()))
 
 
 @app.route("/user/<int:user_id>/")
 def getUser(user_id):
     #user = User.query.filter_by(id=user_id).first()
-    user = dao.getUser(user_id)
+    version = dao.userVersion(user_id)
+    if version is None:
+        return failure_response("User cannot be found!")
+    tag = etag("user", user_id, version)
+    if not_modified(tag):
+        return conditional_response(tag)
+    user = dao.getUser(user_id, **user_fields())
     if user is None:
         return failure_response("User cannot be found!")
-    return success_response(user, 200)
+    return conditional_response(tag, success_response(user, 200))
+
+
+# several users in one request: {"ids": [...]}; see dao.batchResult
+@app.route("/users/batch/", methods=["POST"])
+def getUsersByIds():
+    ids = batch_ids()
+    if ids is None:
+        return failure_response(f"ids must be a list of at most {dao.MAX_BATCH_SIZE} user ids!", 400)
+    return success_response(dao.getUsersByIds(ids, **user_fields()))
 
 
 @app.route("/register/", methods=["POST"])
 def register():
 
-    body = json.loads(request.data)
+    body = encoding.requestBody()
     username = body.get("username")
     
     password = body.get("password")
@@ -114,11 +320,11 @@ def register():
 def follow(follower_user_id):
     #no error if relationship already exists
 
-    followed_user_id = json.loads(request.data).get("followed_user_id")
+    followed_user_id = encoding.requestBody().get("followed_user_id")
     
     if follower_user_id == followed_user_id:
         return failure_response("User and follower ids are the same!")
-    if dao.getUser(follower_user_id) is None or dao.getUser(followed_user_id) is None:
+    if not dao.userExists(follower_user_id) or not dao.userExists(followed_user_id):
         return failure_response("One or both of those users cannot be found!")
     
     follower = dao.follow(follower_user_id=follower_user_id, followed_user_id=followed_user_id)
@@ -132,11 +338,11 @@ def follow(follower_user_id):
 def unfollow(follower_user_id):
     #no error if relationship does not exist 
 
-    followed_user_id = json.loads(request.data).get("followed_user_id")
+    followed_user_id = encoding.requestBody().get("followed_user_id")
 
     if follower_user_id == followed_user_id:
         return failure_response("User and follower ids are the same!")
-    if dao.getUser(follower_user_id) is None or dao.getUser(followed_user_id) is None:
+    if not dao.userExists(follower_user_id) or not dao.userExists(followed_user_id):
         return failure_response("One or both of these users cannot be found!")
     
     follower = dao.unfollow(follower_user_id=follower_user_id, followed_user_id=followed_user_id)
@@ -162,13 +368,12 @@ def getFollowersUsernames(user_id):
 @app.route("/user/<int:user_id>/post/", methods=["POST"])
 def post(user_id):
 
-    user = dao.getUser(user_id)
-    if user is None:
+    if not dao.userExists(user_id):
         return failure_response("User cannot be found!") 
 
     # case post was not created for whatever reason, possibly because of incorrect request data
     # still need to fix dateTime functionality, time functionality (only accepts ints rn)
-    body = json.loads(request.data)
+    body = encoding.requestBody()
 
     difficultyRating=body.get("difficultyRating")
     if(difficultyRating>3 or difficultyRating<0):
@@ -195,10 +400,9 @@ def post(user_id):
 # add tag to post
 @app.route("/post/<int:post_id>/tag/", methods=["POST"])
 def addTags(post_id):
-    body = json.loads(request.data)
+    body = encoding.requestBody()
     tags = body.get("tags") # array of strings
-    post = dao.getPost(post_id)
-    if post is None:
+    if not dao.postExists(post_id):
         return failure_response("Post cannot be found!") 
     post = dao.updateTags(post_id, tags=tags)
     if post is None:
@@ -208,40 +412,83 @@ def addTags(post_id):
 # get post by post id
 @app.route("/post/<int:post_id>/")
 def getPost(post_id):
-    post = dao.getPost(post_id)
+    version = dao.postVersion(post_id)
+    if version is None:
+        return failure_response("Post does not exist!")
+    tag = etag("post", post_id, version)
+    if not_modified(tag):
+        return conditional_response(tag)
+    post = dao.getPost(post_id, **post_fields())
     if post is None:
         return failure_response("Post does not exist!")
-    return success_response(post, 200)
+    return conditional_response(tag, success_response(post, 200))
+
+# several posts in one request: {"ids": [...]}; see dao.batchResult
+@app.route("/posts/batch/", methods=["POST"])
+def getPostsByIds():
+    ids = batch_ids()
+    if ids is None:
+        return failure_response(f"ids must be a list of at most {dao.MAX_BATCH_SIZE} post ids!", 400)
+    return success_response(dao.getPostsByIds(ids, **post_fields()))
 
 @app.route("/posts/")
 def getPosts():
-    return success_response(dao.getPosts())
+    return success_response(dao.getPosts(**page_args(), **post_fields()))
 
 # get posts by user id
 @app.route("/user/<int:user_id>/posts/")
 def getPostsByUser(user_id):
-    posts = dao.getPostsByUser(user_id)
+    version = dao.userVersion(user_id)
+    if version is None:
+        return failure_response("User not found!")
+    tag = etag("posts", user_id, version)
+    if not_modified(tag):
+        return conditional_response(tag)
+    posts = dao.getPostsByUser(user_id, **page_args(), **post_fields())
     if posts is None:
         return failure_response("User not found!")
-    return success_response(posts, 200)
+    return conditional_response(tag, success_response(posts, 200))
 
 @app.route("/posts/filter/", methods=["POST"])
 def getPostsByFilters():
-    body = json.loads(request.data)
+    body = encoding.requestBody()
     tags = body.get("tags")
     price = body.get("price")
     difficulty = body.get("difficulty")
     if tags is None and price is None and difficulty is None:
         return failure_response("No filters selected!")
-    posts = dao.getPostsByFilters(tags=tags, price=price, difficulty=difficulty)
+    posts = dao.getPostsByFilters(tags=tags, price=price, difficulty=difficulty, **page_args(), **post_fields())
     if posts is None:
         return failure_response("Could not get posts with the specified filters!")
     return success_response(posts)
 
+# full-text search over titles, ingredients and recipes: {"query": ..., "tags", "price",
+# "difficulty"}; results are always paginated
+@app.route("/posts/search/", methods=["POST"])
+def searchPosts():
+    body = encoding.requestBody()
+    query = body.get("query")
+    if not query:
+        return failure_response("No search query!", 400)
+    posts = dao.searchPosts(query, tags=body.get("tags"), price=body.get("price"),
+        difficulty=body.get("difficulty"), **page_args(), **post_fields())
+    return success_response(posts)
+
+# "what can I cook": {"ingredients": [...], "tags", "price", "difficulty"}; posts are ranked by
+# how much of their ingredient list the student has and are always paginated
+@app.route("/posts/cookable/", methods=["POST"])
+def cookablePosts():
+    body = encoding.requestBody()
+    have = body.get("ingredients")
+    if not isinstance(have, list) or not all(isinstance(i, str) for i in have):
+        return failure_response("ingredients must be a list of strings!", 400)
+    posts = dao.cookablePosts(have, tags=body.get("tags"), price=body.get("price"),
+        difficulty=body.get("difficulty"), **page_args(), **post_fields())
+    return success_response(posts)
+
 @app.route("/post/<int:post_id>/delete/", methods=["DELETE"])
 def deletePost(post_id):
-    post = dao.getPost(post_id)
-    if post is None:
+    if not dao.postExists(post_id):
         return failure_response("Post was not found!")
     post = dao.deletePost(post_id)
     if post is None:
@@ -250,18 +497,18 @@ def deletePost(post_id):
 
 @app.route("/ratings/")
 def getAllRatings():
-    return success_response(dao.getAllRatings(),200)
+    return success_response(dao.getAllRatings(**page_args()),200)
 
 @app.route("/post/<int:post_id>/difficulty/")
 def getDifficultyRating(post_id):
-    post = dao.getPost(post_id)
+    post = dao.getPost(post_id, EXISTS_POST)
     if post is None:
         return failure_response("That post was not found!")
     return dao.getDifficultyRating(post_id)
 
 @app.route("/post/<int:post_id>/price/")
 def getPriceRating(post_id):
-    post = dao.getPost(post_id)
+    post = dao.getPost(post_id, EXISTS_POST)
     if post is None:
         return failure_response("That post was not found!")
     return dao.getPriceRating(post_id)
@@ -269,13 +516,13 @@ def getPriceRating(post_id):
 #overall rating routes
 @app.route("/post/<int:post_id>/overall/", methods=["POST"])
 def rateOverall(post_id):
-    body = json.loads(request.data)
+    body = encoding.requestBody()
     
     score = body.get("score")
     if score < 0 or score > 5:
         return failure_response("The score must be in between 0 and 5!")
 
-    if dao.getPost(post_id) is None:
+    if not dao.postExists(post_id):
         return failure_response("That post was not found!")
 
     user_id = body.get("user_id")
@@ -289,7 +536,7 @@ def rateOverall(post_id):
 
 @app.route("/post/<int:post_id>/overall/")
 def getOverallRating(post_id):
-    post = dao.getPost(post_id)
+    post = dao.getPost(post_id, EXISTS_POST)
     if post is None:
         return failure_response("That post was not found!")
     return dao.getOverallRating(post_id)
@@ -297,23 +544,106 @@ def getOverallRating(post_id):
 #can pass a list of tags, but not neccessary. 
 @app.route("/posts/popular/", methods=["POST"])
 def getPopularPostsbyTags():
-    body = json.loads(request.data)
+    body = encoding.requestBody()
     tags = body.get("tags") 
     price = body.get("price")
     difficulty = body.get("difficulty")
-    return success_response(dao.getPopularPostsbyTags(tags=tags,price=price, difficulty=difficulty),200)
+    return success_response(dao.getPopularPostsbyTags(tags=tags,price=price, difficulty=difficulty, **page_args(), **post_fields()),200)
 
 
-@app.route("/user/<int:user_id>/following/posts/", methods=["POST"])
+# filters come from the JSON body, or for GET from ?tags=a,b&price=&difficulty= so the feed can be
+# polled with If-None-Match
+@app.route("/user/<int:user_id>/following/posts/", methods=["GET", "POST"])
 def getFollowingPostsByTags(user_id):
-    body = json.loads(request.data)
-    tags = body.get("tags") 
-    price = body.get("price")
-    difficulty = body.get("difficulty")
-    followingPosts = dao.getFollowingPostsByTags(user_id, tags=tags, price=price, difficulty=difficulty)
+    if request.method == "GET":
+        tags = request.args.get("tags")
+        tags = tags.split(",") if tags else None
+        price = request.args.get("price", type=int)
+        difficulty = request.args.get("difficulty", type=int)
+    else:
+        body = encoding.requestBody()
+        tags = body.get("tags") 
+        price = body.get("price")
+        difficulty = body.get("difficulty")
+    version = dao.feedVersion(user_id)
+    if version is None:
+        return failure_response("User does not exist!")
+    tag = etag("feed", user_id, *version)
+    if not_modified(tag):
+        return conditional_response(tag)
+    followingPosts = dao.getFollowingPostsByTags(user_id, tags=tags, price=price, difficulty=difficulty, **page_args(), **post_fields())
     if followingPosts is None:
         return failure_response("User does not exist!")
-    return success_response(followingPosts, 200)
+    return conditional_response(tag, success_response(followingPosts, 200))
+
+
+########## COMMANDS ##############
+
+# imports NDJSON users, posts and ratings from the request body, see bulk.py; the body is read
+# line by line and the response counts what was imported and lists what was rejected
+@app.route("/bulk/import/", methods=["POST"])
+def bulkImport():
+    return success_response(bulk.importRecords(request.stream))
+
+# streams every user, post and rating as NDJSON, or only the ?types=user,post,rating asked for;
+# passwords are left out
+@app.route("/bulk/export/")
+def bulkExport():
+    kinds = request.args.get("types", ",".join(bulk.KINDS)).split(",")
+    unknown = [k for k in kinds if k not in bulk.KINDS]
+    if unknown:
+        return failure_response(f"Unknown types {', '.join(unknown)}", 400)
+    return app.response_class(stream_with_context(bulk.exportRecords(kinds)), mimetype="application/x-ndjson")
+
+
+@app.cli.command("rebuild-timelines")
+def rebuild_timelines():
+    # run once after turning TIMELINE_FANOUT on for an existing database
+    timeline.rebuild()
+
+@app.cli.command("backfill-ratings")
+def backfill_ratings():
+    # recomputes the rating counters, overallRating and popularity of every post from Ratings
+    dao.backfillRatings()
+    dao.bumpAllVersions()
+
+@app.cli.command("import-ndjson")
+@click.argument("source", type=click.File("rb"))
+def import_ndjson(source):
+    # bulk-imports an NDJSON file of users, posts and ratings, see bulk.py; "-" reads stdin
+    summary = bulk.importRecords(source)
+    print(f"Imported {summary['users']} users, {summary['posts']} posts and {summary['ratings']} ratings")
+    for error in summary["errors"]:
+        print(f"line {error['line']}: {error['error']}")
+    if summary["rejected"]:
+        print(f"Rejected {summary['rejected']} records")
+        sys.exit(1)
+
+@app.cli.command("export-ndjson")
+@click.argument("target", type=click.File("wb"))
+def export_ndjson(target):
+    # writes every user, post and rating as NDJSON, passwords included, for import-ndjson
+    for line in bulk.exportRecords(passwords=True):
+        target.write(line)
+
+@app.cli.command("copy-to-replicas")
+def copy_to_replicas():
+    # copies a SQLite primary over its SQLite replicas; real replicas are kept up to date by the database
+    copied = database.copyToReplicas(app)
+    print(f"Copied the database to {', '.join(copied)}" if copied else "No SQLite replicas to copy to")
+
+@app.cli.command("check-query-plans")
+def check_query_plans():
+    # exits non-zero when a hot dao query falls back to a full table scan, for use in CI
+    if db.engine.dialect.name != "sqlite":
+        print("check-query-plans reads SQLite plans; use EXPLAIN on other databases")
+        return
+    failures = queryplans.fullScans()
+    for name, scans in failures.items():
+        print(f"{name}: {', '.join(scans)}")
+    if failures:
+        sys.exit(1)
+    print("No full table scans in hot queries")
 
 
 #TODO
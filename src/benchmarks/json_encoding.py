@@ -0,0 +1,54 @@
+import gzip
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import encoding
+
+# Micro-benchmark of the JSON backends in encoding.py on a /posts/ response body. Run it from
+# src/ with `python benchmarks/json_encoding.py [number of posts]`.
+
+
+def post(i):
+    return {
+        "post_id": i,
+        "title": f"Recipe number {i}",
+        "dateTime": "Jan-01-2021-12:00",
+        "ingredients": "2 eggs, 1 cup flour, 1 cup milk, 1 tbsp butter, salt",
+        "recipe": "Whisk the eggs and milk, fold in the flour and fry in butter. " * 8,
+        "recipeTime": 20,
+        "difficultyRating": 2,
+        "overallRating": 4.25,
+        "priceRating": 1,
+        "user_id": i % 50,
+        "comments": [{"comment_id": i * 10 + c, "comment": "Great!", "user_id": c, "post_id": i} for c in range(3)],
+        "tags": ["vegetarian", "breakfast"],
+        "photos": [{
+            "image_id": i,
+            "img_type": "post",
+            "type_id": i,
+            "url": f"https://recipeappimages.s3-us-east-2.amazonaws.com/{i:064x}.jpg",
+            "width": 1200,
+            "height": 900,
+            "status": "ready",
+            "variants": {}
+        }]
+    }
+
+def main(count):
+    payload = {"success": True, "data": [post(i) for i in range(count)]}
+    runs = 20
+    for name in sorted(encoding.BACKENDS):
+        dumps, loads = encoding.BACKENDS[name]
+        body = dumps(payload)
+        seconds = timeit.timeit(lambda: dumps(payload), number=runs) / runs
+        parse = timeit.timeit(lambda: loads(body), number=runs) / runs
+        print(f"{name:>7}: encode {seconds * 1000:7.2f} ms  decode {parse * 1000:7.2f} ms  {len(body)} bytes")
+    body = encoding.dumps(payload)
+    seconds = timeit.timeit(lambda: gzip.compress(body, compresslevel=encoding.COMPRESS_LEVEL), number=runs) / runs
+    size = len(gzip.compress(body, compresslevel=encoding.COMPRESS_LEVEL))
+    print(f"   gzip: {seconds * 1000:7.2f} ms  {size} bytes")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,253 @@
+import argparse
+import base64
+from io import BytesIO
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import db, Post, Rating, Asset, User
+from PIL import Image
+from seed import zipfWeights
+from sqlalchemy import event
+
+# Load benchmark of every route in app.py, through Flask's test client, against a copy of a
+# database filled by benchmarks/seed.py, with images kept in memory. Each route gets --warmup
+# requests and then --requests timed ones, with ids drawn so popular users and posts are hit more,
+# as in real traffic. It reports p50/p95/p99 latency, throughput and SQL statements per request.
+# --save writes the results as a baseline and --compare checks a run against one. Run it from src/:
+#
+#   python benchmarks/seed.py
+#   python benchmarks/run.py --save benchmarks/baseline.json
+#   python benchmarks/run.py --compare benchmarks/baseline.json
+#
+# The cache, JSON and timeline settings come from the environment as usual, so
+# CACHE_BACKEND=none measures the database path on every request. --database also takes a URL
+# such as postgresql://localhost/bench, to compare SQLite with a server database.
+
+REGRESSION = 0.2 # a p95 this much slower than the baseline fails --compare
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def png(number):
+    buffer = BytesIO()
+    Image.new("RGB", (64, 48), (number % 256, number // 256 % 256, 90)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+# what the scenarios draw their ids from
+class Data:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.users = [u for u, in db.session.query(User.id).order_by(User.id)]
+        self.posts = [p for p, in db.session.query(Post.id).order_by(Post.id)]
+        self.assets = [a for a, in db.session.query(Asset.id).order_by(Asset.id)]
+        rated = {p for p, in db.session.query(Rating.post_id).distinct()}
+        # deleting a post with ratings fails, so deletePost only gets unrated ones
+        self.unrated = [p for p in self.posts if p not in rated]
+        self.userWeights = zipfWeights(len(self.users))
+        self.postWeights = zipfWeights(len(self.posts))
+        self.counter = 0
+
+    def user(self):
+        return self.rng.choices(self.users, weights=self.userWeights)[0]
+
+    def post(self):
+        return self.rng.choices(self.posts, weights=self.postWeights)[0]
+
+    def pair(self):
+        follower, followed = self.user(), self.user()
+        while followed == follower:
+            followed = self.user()
+        return follower, followed
+
+    def unique(self):
+        self.counter += 1
+        return self.counter
+
+    # ids that a request consumes, such as a post to delete
+    def take(self, ids):
+        return ids.pop() if ids else 0
+
+
+def body(data):
+    return {"data": json.dumps(data)}
+
+def filters(d):
+    return {"tags": d.rng.sample(["vegan", "breakfast", "asian", "dessert"], d.rng.randint(0, 2)),
+        "price": d.rng.choice([None, 1, 2, 3]), "difficulty": d.rng.choice([None, 1, 2])}
+
+def newPost(d):
+    return {"title": "Benchmark noodles", "ingredients": "ramen noodle, egg, 1 tbsp soy sauce", "recipe": "Boil and stir.",
+        "recipeTime": 10, "difficultyRating": 1, "priceRating": 1}
+
+def ndjson(d):
+    user = d.unique()
+    records = [{"type": "user", "username": f"bulk{user}", "password": "p"}] + [
+        dict(newPost(d), type="post", user_id=d.user()) for i in range(20)]
+    return "\n".join(json.dumps(r) for r in records)
+
+# (rule, method) -> the path and test client arguments of one request
+SCENARIOS = {
+    ("/user/image/upload/", "POST"): lambda d: ("/user/image/upload/", body({
+        "imageData": "data:image/png;base64," + base64.b64encode(png(d.unique())).decode(),
+        "imgType": "post", "typeId": d.post()})),
+    ("/user/image/upload/stream/", "POST"): lambda d: (f"/user/image/upload/stream/?imgType=post&typeId={d.post()}",
+        {"data": png(d.unique()), "content_type": "image/png"}),
+    ("/image/<int:img_id>/", "GET"): lambda d: (f"/image/{d.rng.choice(d.assets)}/", {}),
+    ("/images/<path:key>", "GET"): lambda d: ("/images/missing.jpg", {}),
+    ("/image/<int:img_id>/delete/", "DELETE"): lambda d: (f"/image/{d.take(d.assets)}/delete/", {}),
+    ("/cache/stats/", "GET"): lambda d: ("/cache/stats/", {}),
+    ("/metrics", "GET"): lambda d: ("/metrics", {}),
+    ("/getUsers/", "GET"): lambda d: ("/getUsers/?limit=20&view=summary", {}),
+    ("/user/<int:user_id>/", "GET"): lambda d: (f"/user/{d.user()}/", {}),
+    ("/users/batch/", "POST"): lambda d: ("/users/batch/?view=summary", body({"ids": [d.user() for i in range(20)]})),
+    ("/register/", "POST"): lambda d: ("/register/", body({"username": f"bench{d.unique()}", "password": "p"})),
+    ("/user/<int:follower_user_id>/follow/", "POST"): lambda d: (lambda f: (f"/user/{f[0]}/follow/",
+        body({"followed_user_id": f[1]})))(d.pair()),
+    ("/user/<int:follower_user_id>/unfollow/", "POST"): lambda d: (lambda f: (f"/user/{f[0]}/unfollow/",
+        body({"followed_user_id": f[1]})))(d.pair()),
+    ("/user/<int:user_id>/following/", "GET"): lambda d: (f"/user/{d.user()}/following/", {}),
+    ("/user/<int:user_id>/followers/", "GET"): lambda d: (f"/user/{d.user()}/followers/", {}),
+    ("/user/<int:user_id>/post/", "POST"): lambda d: (f"/user/{d.user()}/post/", body(newPost(d))),
+    ("/post/<int:post_id>/tag/", "POST"): lambda d: (f"/post/{d.post()}/tag/", body({"tags": ["breakfast"]})),
+    ("/post/<int:post_id>/", "GET"): lambda d: (f"/post/{d.post()}/", {}),
+    ("/posts/batch/", "POST"): lambda d: ("/posts/batch/?view=summary", body({"ids": [d.post() for i in range(20)]})),
+    ("/posts/", "GET"): lambda d: ("/posts/?limit=20", {}),
+    ("/user/<int:user_id>/posts/", "GET"): lambda d: (f"/user/{d.user()}/posts/?limit=20", {}),
+    ("/posts/filter/", "POST"): lambda d: ("/posts/filter/?limit=20", body(filters(d))),
+    ("/posts/search/", "POST"): lambda d: ("/posts/search/?limit=20&view=summary",
+        body({"query": d.rng.choice(["rice", "egg", "spicy curry", "pancake", "chick"])})),
+    ("/posts/cookable/", "POST"): lambda d: ("/posts/cookable/?limit=20&view=summary",
+        body({"ingredients": d.rng.sample(["rice", "eggs", "milk", "flour", "garlic", "onion", "tofu"], 3)})),
+    ("/post/<int:post_id>/delete/", "DELETE"): lambda d: (f"/post/{d.take(d.unrated)}/delete/", {}),
+    ("/ratings/", "GET"): lambda d: ("/ratings/?limit=20", {}),
+    ("/post/<int:post_id>/difficulty/", "GET"): lambda d: (f"/post/{d.post()}/difficulty/", {}),
+    ("/post/<int:post_id>/price/", "GET"): lambda d: (f"/post/{d.post()}/price/", {}),
+    ("/post/<int:post_id>/overall/", "POST"): lambda d: (f"/post/{d.post()}/overall/",
+        body({"user_id": d.user(), "score": d.rng.randint(0, 5)})),
+    ("/post/<int:post_id>/overall/", "GET"): lambda d: (f"/post/{d.post()}/overall/", {}),
+    ("/posts/popular/", "POST"): lambda d: ("/posts/popular/?limit=20", body(filters(d))),
+    ("/user/<int:user_id>/following/posts/", "GET"): lambda d: (f"/user/{d.user()}/following/posts/?limit=20", {}),
+    ("/user/<int:user_id>/following/posts/", "POST"): lambda d: (f"/user/{d.user()}/following/posts/?limit=20",
+        body(filters(d))),
+    ("/bulk/import/", "POST"): lambda d: ("/bulk/import/", {"data": ndjson(d)}),
+    ("/bulk/export/", "GET"): lambda d: ("/bulk/export/?types=user", {})
+}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        # background uploads run their own statements, which belong to no request
+        self.thread = threading.current_thread()
+
+    def __call__(self, *args):
+        if threading.current_thread() is self.thread:
+            self.count += 1
+
+def measure(client, data, counter, rule, method, warmup, requests):
+    latencies, queries, errors = [], [], 0
+    for number in range(warmup + requests):
+        path, kwargs = SCENARIOS[(rule, method)](data)
+        before = counter.count
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        response.get_data() # drains streamed bodies
+        elapsed = time.perf_counter() - start
+        if number < warmup:
+            continue
+        latencies.append(elapsed)
+        queries.append(counter.count - before)
+        if response.status_code >= 400:
+            errors += 1
+    return {
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "rps": len(latencies) / sum(latencies),
+        "queries": sum(queries) / len(queries),
+        "errors": errors
+    }
+
+def run(database, warmup, requests, seed):
+    copy = None
+    if "://" in database: # a server database is used as is, so the write routes change it
+        os.environ["DATABASE_URL"] = database
+    else:
+        copy = os.path.join(tempfile.mkdtemp(), "bench.db")
+        shutil.copy(database, copy)
+        os.environ["DATABASE_URL"] = "sqlite:///" + copy
+    os.environ["STORAGE_BACKEND"] = "memory"
+    from app import app # reads DATABASE_URL
+    app.config["SQLALCHEMY_ECHO"] = False
+    results = {}
+    with app.app_context():
+        data = Data(seed)
+        counter = QueryCounter()
+        event.listen(db.engine, "after_cursor_execute", counter)
+    rules = {(r.rule, m) for r in app.url_map.iter_rules() if r.endpoint != "static"
+        for m in r.methods - {"HEAD", "OPTIONS"}}
+    for missing in sorted(rules - set(SCENARIOS)):
+        print(f"warning: no scenario for {missing[1]} {missing[0]}")
+    client = app.test_client()
+    for rule, method in sorted(set(SCENARIOS) & rules):
+        results[f"{method} {rule}"] = measure(client, data, counter, rule, method, warmup, requests)
+    if copy is not None:
+        shutil.rmtree(os.path.dirname(copy))
+    return results
+
+def report(results, baseline=None):
+    print(f"{'route':<48} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8} {'errors':>6}")
+    for name, r in results.items():
+        line = f"{name:<48} {r['p50']:8.2f} {r['p95']:8.2f} {r['p99']:8.2f} {r['rps']:8.0f} {r['queries']:8.1f} {r['errors']:6}"
+        old = (baseline or {}).get(name)
+        if old is not None:
+            line += f"  p95 {change(old['p95'], r['p95'])} queries {change(old['queries'], r['queries'])}"
+        print(line)
+
+def change(old, new):
+    return f"{(new - old) / old * 100:+.0f}%" if old else f"{new - old:+.1f}"
+
+# the routes whose p95 grew by more than threshold or that run more statements than before
+def regressions(results, baseline, threshold):
+    return [name for name, r in results.items() if name in baseline and (
+        r["p95"] > baseline[name]["p95"] * (1 + threshold) or r["queries"] > baseline[name]["queries"] + 0.5)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every route against a seeded database")
+    parser.add_argument("--database", default="benchmarks/bench.db", help="SQLite file or database URL filled by seed.py")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per route")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="compare the results with this baseline file")
+    parser.add_argument("--max-regression", type=float, default=REGRESSION)
+    args = parser.parse_args()
+
+    results = run(args.database, args.warmup, args.requests, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["routes"]
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"requests": args.requests, "seed": args.seed, "routes": results}, f, indent=2)
+    if baseline is not None:
+        slower = regressions(results, baseline, args.max_regression)
+        for name in slower:
+            print(f"regression: {name}")
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dao
+import database
+from db import db, User, Post, Rating, Comment, Asset, followers, TAGS, TAG_BITS
+import ingredients
+import search
+import storage
+import timeline
+
+# Fills a fresh database with synthetic users, follows, posts, ratings, comments and photos for
+# benchmarks/run.py. Activity is skewed the way it is on real social apps: user popularity follows
+# a Zipf distribution, so a few users have most of the followers, write most of the posts and
+# collect most of the ratings. The same --seed always produces the same data. Run it from src/:
+#
+#   python benchmarks/seed.py --users 2000 --database benchmarks/bench.db
+#
+# --database also takes the URL of a new, empty server database such as postgresql://localhost/bench.
+
+BATCH_SIZE = 1000 # rows per executemany insert
+ZIPF = 1.1 # exponent of the popularity distribution; higher is more skewed
+
+INGREDIENTS = [
+    "rice", "egg", "pasta", "onion", "garlic", "olive oil", "butter", "salt", "pepper", "milk",
+    "flour", "sugar", "tomato", "cheese", "chicken", "beef", "tofu", "black bean", "potato", "carrot",
+    "spinach", "bread", "soy sauce", "ginger", "lemon", "yogurt", "oat", "banana", "peanut butter",
+    "honey", "broccoli", "mushroom", "bell pepper", "tortilla", "lentil", "chickpea", "coconut milk",
+    "curry powder", "cinnamon", "apple", "frozen pea", "ramen noodle", "sriracha", "basil", "corn"
+]
+UNITS = ["1 cup", "2 cups", "1 tbsp", "2 tbsp", "1 tsp", "3", "2", "1", "a handful of", "1 can"]
+DISHES = ["fried rice", "pasta bake", "omelette", "stir fry", "curry", "soup", "salad", "tacos",
+    "pancakes", "noodles", "quesadilla", "oatmeal", "smoothie", "chili", "toast", "bowl"]
+ADJECTIVES = ["Easy", "Quick", "Cheap", "Cozy", "Spicy", "Late night", "One pot", "Dorm room",
+    "Five minute", "Healthy", "Lazy", "Crispy"]
+
+
+def zipfWeights(count, exponent=ZIPF):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+# count distinct indexes into weights, drawn in proportion to them
+def sample(rng, weights, count):
+    picked = set()
+    count = min(count, len(weights))
+    while len(picked) < count:
+        picked.update(rng.choices(range(len(weights)), weights=weights, k=count - len(picked)))
+    return picked
+
+def ingredientList(rng, weights):
+    items = [INGREDIENTS[i] for i in sample(rng, weights, rng.randint(3, 8))]
+    return ", ".join(f"{rng.choice(UNITS)} {item}" for item in items)
+
+def insertAll(table, rows):
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + BATCH_SIZE])
+
+def seed(users, postsPerUser, ratingsPerPost, followsPerUser, photoShare, randomSeed):
+    rng = random.Random(randomSeed)
+    # user i has popularity rank i + 1; ids are shuffled so rank does not follow id order
+    ids = list(range(1, users + 1))
+    rng.shuffle(ids)
+    popularity = zipfWeights(users)
+    ingredientWeights = zipfWeights(len(INGREDIENTS), 0.8)
+
+    insertAll(User.__table__, [
+        {"id": i, "username": f"student{i}", "password": "password", "bio": f"Bio of student {i}"}
+        for i in range(1, users + 1)
+    ])
+
+    # out-degrees are skewed too, and targets are drawn by popularity, so in-degrees follow a power law
+    follows = []
+    for follower in range(users):
+        degree = min(users - 1, int(rng.paretovariate(1.5) * followsPerUser / 3))
+        follows += [{"followerID": ids[follower], "followedID": ids[followed]}
+            for followed in sample(rng, popularity, degree) if followed != follower]
+    insertAll(followers, follows)
+
+    totalPosts = users * postsPerUser
+    authors = rng.choices(range(users), weights=popularity, k=totalPosts)
+    start = datetime.datetime(2020, 9, 1)
+    posts = []
+    for number, author in enumerate(authors, start=1):
+        tags = [t for t in TAGS if rng.random() < 0.15]
+        posts.append({
+            "id": number,
+            "userID": ids[author],
+            "title": f"{rng.choice(ADJECTIVES)} {rng.choice(DISHES)}",
+            "dateTime": start + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+            "ingredients": ingredientList(rng, ingredientWeights),
+            "recipe": " ".join(f"Step {s}: cook the {rng.choice(INGREDIENTS)} for {rng.randint(1, 15)} minutes."
+                for s in range(1, rng.randint(3, 9))),
+            "recipeTime": rng.choice([5, 10, 15, 20, 30, 45, 60]),
+            "difficultyRating": rng.randint(1, 3),
+            "priceRating": rng.randint(1, 3),
+            "overallRating": 0,
+            "tagMask": sum(TAG_BITS[t] for t in tags)
+        })
+    insertAll(Post.__table__, posts)
+
+    # posts by popular authors get more ratings; counts are heavy tailed either way, and many
+    # posts get none
+    ratings, comments, photos = [], [], []
+    for post, author in zip(posts, authors):
+        count = int(rng.paretovariate(1.2) * ratingsPerPost * (1 + popularity[author] * 10) / 5) - 1
+        for rater in sample(rng, popularity, min(count, users // 2)):
+            ratings.append({
+                "post_id": post["id"], "user_id": ids[rater], "overallRating": min(5, max(0, round(rng.gauss(3.8, 1)))),
+                "difficultyRating": None, "priceRating": None
+            })
+        for c in range(int(rng.paretovariate(1.5)) - 1):
+            comments.append({"comment": rng.randint(1, 1000), "userID": rng.randint(1, users), "postID": post["id"]})
+        if rng.random() < photoShare:
+            photos.append({
+                "img_type": "post", "post_id": post["id"], "profile_id": None, "base_url": storage.current().base_url,
+                "salt": f"{rng.getrandbits(256):064x}", "extension": "jpg",
+                "width": 1200, "height": 900, "status": "ready"
+            })
+    insertAll(Rating.__table__, ratings)
+    insertAll(Comment.__table__, comments)
+    insertAll(Asset.__table__, photos)
+    database.syncSequences(User.__table__, Post.__table__)
+    db.session.commit()
+
+    dao.backfillRatings()
+    ingredients.indexAll()
+    # the search index was created empty by migrations.upgrade() when app.py was imported
+    search.indexNew([(p["id"], p["title"], p["ingredients"], p["recipe"]) for p in posts])
+    db.session.commit()
+    if timeline.enabled():
+        timeline.rebuild()
+    return {"users": users, "follows": len(follows), "posts": len(posts), "ratings": len(ratings),
+        "comments": len(comments), "photos": len(photos)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill a new database with synthetic data")
+    parser.add_argument("--database", default="benchmarks/bench.db", help="SQLite file to create, or URL of an empty database")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts-per-user", type=int, default=5, help="mean; popular users write more")
+    parser.add_argument("--ratings-per-post", type=int, default=5, help="scale of the rating counts")
+    parser.add_argument("--follows-per-user", type=int, default=20, help="scale of the follow counts")
+    parser.add_argument("--photo-share", type=float, default=0.5, help="share of posts with a photo")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if "://" in args.database:
+        os.environ["DATABASE_URL"] = args.database
+    else:
+        if os.path.exists(args.database):
+            os.remove(args.database)
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.abspath(args.database)
+    os.environ.setdefault("STORAGE_BACKEND", "memory")
+    from app import app # reads DATABASE_URL and creates the schema
+    with app.app_context():
+        counts = seed(args.users, args.posts_per_user, args.ratings_per_post, args.follows_per_user,
+            args.photo_share, args.seed)
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+
+if __name__ == "__main__":
+    main()
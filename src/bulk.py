@@ -0,0 +1,293 @@
+from db import db, User, Post, Rating, chunked, commitChanges, maskFor, tagNames, UnknownTag
+import dao
+import database
+import datetime
+import encoding
+import ingredients
+from pagination import keysetFilter
+import search
+import timeline
+
+# Bulk NDJSON import and export of users, posts and ratings, one JSON record per line:
+#   {"type": "user", "id": 1, "username": ..., "password": ..., "bio": ...}
+#   {"type": "post", "id": 1, "user_id": 1, "title": ..., "ingredients": ..., "recipe": ...,
+#    "recipeTime": 5, "difficultyRating": 1, "priceRating": 1, "tags": [...], "dateTime": "2020-12-14T22:03:00"}
+#   {"type": "rating", "post_id": 1, "user_id": 2, "overallRating": 4}
+# "id" is optional and lets later records refer to earlier ones. Imports read the records as a
+# stream and write every BATCH_SIZE of them in one transaction, with one executemany insert per
+# table. Invalid records are skipped and reported by line number. Exports walk each table in id
+# order, BATCH_SIZE rows at a time, so both directions run in constant memory.
+
+BATCH_SIZE = 500 # records per transaction
+MAX_ERRORS = 100 # errors listed in an import summary; the rest are only counted
+KINDS = ("user", "post", "rating") # also the import order within a batch
+
+
+class InvalidRecord(ValueError):
+    pass
+
+def field(record, name, kind, required=True, low=None, high=None):
+    value = record.get(name)
+    if value is None:
+        if required:
+            raise InvalidRecord(f"{name} is required")
+        return None
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise InvalidRecord(f"{name} must be {'an integer' if kind is int else 'a string'}")
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise InvalidRecord(f"{name} must be between {low} and {high}")
+    return value
+
+def withId(row, record):
+    if record.get("id") is not None:
+        row["id"] = field(record, "id", int, low=1)
+    return row
+
+def userRow(record):
+    return withId({
+        "username": field(record, "username", str),
+        "password": field(record, "password", str),
+        "bio": field(record, "bio", str, required=False)
+    }, record)
+
+def postRow(record):
+    try:
+        tagMask = maskFor(record.get("tags"))
+    except UnknownTag as e:
+        raise InvalidRecord(str(e))
+    dateTime = field(record, "dateTime", str, required=False)
+    try:
+        dateTime = datetime.datetime.now() if dateTime is None else datetime.datetime.fromisoformat(dateTime)
+    except ValueError:
+        raise InvalidRecord(f"dateTime {dateTime} is not an ISO 8601 date and time")
+    return withId({
+        "userID": field(record, "user_id", int),
+        "title": field(record, "title", str),
+        "dateTime": dateTime,
+        "ingredients": field(record, "ingredients", str),
+        "recipe": field(record, "recipe", str, required=False),
+        "recipeTime": field(record, "recipeTime", int, low=0),
+        "difficultyRating": field(record, "difficultyRating", int, low=0, high=3),
+        "priceRating": field(record, "priceRating", int, low=0, high=3),
+        "overallRating": 0,
+        "tagMask": tagMask
+    }, record)
+
+def ratingRow(record):
+    return {
+        "post_id": field(record, "post_id", int),
+        "user_id": field(record, "user_id", int),
+        "overallRating": field(record, "overallRating", int, required=False, low=0, high=5),
+        "difficultyRating": field(record, "difficultyRating", int, required=False, low=0, high=3),
+        "priceRating": field(record, "priceRating", int, required=False, low=0, high=3)
+    }
+
+ROWS = {"user": userRow, "post": postRow, "rating": ratingRow}
+
+# the values of column among values that are already in the database
+def existing(column, values):
+    found = set()
+    for chunk in chunked(list(set(values))):
+        found.update(v for v, in db.session.query(column).filter(column.in_(chunk)))
+    return found
+
+# one executemany insert per set of keys, since rows with and without an explicit id differ
+def insertMany(table, rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        db.session.execute(table.insert(), group)
+
+
+class Importer:
+    def __init__(self):
+        self.pending = {kind: [] for kind in KINDS}
+        self.counts = {kind: 0 for kind in KINDS}
+        self.errors = []
+        self.rejected = 0
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def add(self, line, text):
+        if not text.strip():
+            return
+        try:
+            record = encoding.loads(text)
+            if not isinstance(record, dict) or record.get("type") not in ROWS:
+                raise InvalidRecord(f"type must be one of {', '.join(KINDS)}")
+            self.pending[record["type"]].append((line, ROWS[record["type"]](record)))
+        except ValueError as e: # InvalidRecord or malformed JSON
+            self.reject(line, str(e))
+            return
+        if sum(len(rows) for rows in self.pending.values()) >= BATCH_SIZE:
+            self.flush()
+
+    # drops the rows for which problem(row) returns a message
+    def keep(self, rows, problem):
+        kept = []
+        for line, row in rows:
+            message = problem(row)
+            if message is None:
+                kept.append((line, row))
+            else:
+                self.reject(line, message)
+        return [row for line, row in kept]
+
+    def insertUsers(self, rows):
+        takenNames = existing(User.username, [row["username"] for line, row in rows])
+        takenIds = existing(User.id, [row["id"] for line, row in rows if "id" in row])
+        def problem(row):
+            if row["username"] in takenNames:
+                return f"username {row['username']} is taken"
+            if row.get("id") in takenIds:
+                return f"user {row['id']} already exists"
+            takenNames.add(row["username"])
+            if "id" in row:
+                takenIds.add(row["id"])
+            return None
+        users = self.keep(rows, problem)
+        insertMany(User.__table__, users)
+        return users
+
+    def insertPosts(self, rows):
+        authors = existing(User.id, [row["userID"] for line, row in rows])
+        takenIds = existing(Post.id, [row["id"] for line, row in rows if "id" in row])
+        def problem(row):
+            if row["userID"] not in authors:
+                return f"user {row['userID']} does not exist"
+            if row.get("id") in takenIds:
+                return f"post {row['id']} already exists"
+            if "id" in row:
+                takenIds.add(row["id"])
+            return None
+        posts = self.keep(rows, problem)
+        insertMany(Post.__table__, posts)
+        return posts
+
+    def insertRatings(self, rows):
+        postIds = existing(Post.id, [row["post_id"] for line, row in rows])
+        userIds = existing(User.id, [row["user_id"] for line, row in rows])
+        taken = set()
+        # userIds holds at most BATCH_SIZE ids, so with 250 post ids per query it stays under
+        # SQLite's 999 bound parameters
+        for chunk in chunked(list(postIds), 250):
+            taken.update(db.session.query(Rating.post_id, Rating.user_id).filter(Rating.post_id.in_(chunk)) \
+                .filter(Rating.user_id.in_(userIds)))
+        def problem(row):
+            pair = (row["post_id"], row["user_id"])
+            if row["post_id"] not in postIds:
+                return f"post {row['post_id']} does not exist"
+            if row["user_id"] not in userIds:
+                return f"user {row['user_id']} does not exist"
+            if pair in taken:
+                return f"user {row['user_id']} already rated post {row['post_id']}"
+            taken.add(pair)
+            return None
+        ratings = self.keep(rows, problem)
+        insertMany(Rating.__table__, ratings)
+        return ratings
+
+    # the posts imported since the last flush are the ones the ingredient index has not seen;
+    # ix_Posts_unindexed holds only those, so the lookup does not grow with the table
+    def indexNewPosts(self):
+        posts = db.session.query(Post.id, Post.userID, Post.title, Post.ingredients, Post.recipe, Post.dateTime) \
+            .filter(Post.ingredientCount.is_(None)).all()
+        search.indexNew([(p.id, p.title, p.ingredients, p.recipe) for p in posts])
+        ingredients.indexNew([(p.id, p.ingredients) for p in posts])
+        if timeline.enabled():
+            for p in posts:
+                timeline.push(p.id, p.userID, p.dateTime)
+        return posts
+
+    def flush(self):
+        try:
+            users = self.insertUsers(self.pending["user"])
+            posts = self.insertPosts(self.pending["post"])
+            database.syncSequences(User.__table__, Post.__table__)
+            ratings = self.insertRatings(self.pending["rating"])
+            newPosts = self.indexNewPosts()
+            ratedPosts = {r["post_id"] for r in ratings}
+            dao.recomputePostRatings(ratedPosts)
+        except Exception:
+            db.session.rollback()
+            raise
+        self.counts["user"] += len(users)
+        self.counts["post"] += len(posts)
+        self.counts["rating"] += len(ratings)
+        self.pending = {kind: [] for kind in KINDS}
+        # new rows are in no cache or ETag yet; their authors and the rated posts are
+        post_ids = ratedPosts | {p.id for p in newPosts}
+        user_ids = {p.userID for p in newPosts}
+        for chunk in chunked(list(ratedPosts)):
+            user_ids.update(u for u, in db.session.query(Post.userID).filter(Post.id.in_(chunk)))
+        commitChanges(list(post_ids), list(user_ids))
+
+    def summary(self):
+        return {
+            "users": self.counts["user"],
+            "posts": self.counts["post"],
+            "ratings": self.counts["rating"],
+            "rejected": self.rejected,
+            "errors": sorted(self.errors, key=lambda e: e["line"])
+        }
+
+# imports the NDJSON records of lines, an iterable of str or bytes such as a file or request
+# stream; returns the number of records imported per type and the rejected ones
+def importRecords(lines):
+    importer = Importer()
+    for number, text in enumerate(lines, start=1):
+        importer.add(number, text)
+    importer.flush()
+    return importer.summary()
+
+
+def exportUsers(passwords):
+    columns = [User.id, User.username, User.bio] + ([User.password] if passwords else [])
+    for user in batches(db.session.query(*columns), User.id):
+        record = {"type": "user", "id": user.id, "username": user.username, "bio": user.bio}
+        if passwords:
+            record["password"] = user.password
+        yield record
+
+def exportPosts(passwords):
+    columns = [Post.id, Post.userID, Post.title, Post.dateTime, Post.ingredients, Post.recipe,
+        Post.recipeTime, Post.difficultyRating, Post.priceRating, Post.tagMask]
+    for post in batches(db.session.query(*columns), Post.id):
+        yield {
+            "type": "post", "id": post.id, "user_id": post.userID, "title": post.title,
+            "dateTime": post.dateTime.isoformat(), "ingredients": post.ingredients, "recipe": post.recipe,
+            "recipeTime": post.recipeTime, "difficultyRating": post.difficultyRating,
+            "priceRating": post.priceRating, "tags": list(tagNames(post.tagMask))
+        }
+
+def exportRatings(passwords):
+    columns = [Rating.post_id, Rating.user_id, Rating.overallRating, Rating.difficultyRating, Rating.priceRating]
+    for rating in batches(db.session.query(*columns), Rating.post_id, Rating.user_id):
+        yield {"type": "rating", **rating._asdict()}
+
+EXPORTS = {"user": exportUsers, "post": exportPosts, "rating": exportRatings}
+
+# the rows of query in key order, BATCH_SIZE at a time, each batch resuming after the last key
+def batches(query, *key):
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(keysetFilter(key, last))
+        rows = page.order_by(*key).limit(BATCH_SIZE).all()
+        yield from rows
+        if len(rows) < BATCH_SIZE:
+            return
+        last = [getattr(rows[-1], c.key) for c in key]
+
+# NDJSON lines, as bytes, of every record of the given types in import order; passwords are
+# left out unless asked for, so such an export cannot be imported as is
+def exportRecords(kinds=KINDS, passwords=False):
+    for kind in KINDS:
+        if kind in kinds:
+            for record in EXPORTS[kind](passwords):
+                yield encoding.dumps(record) + b"\n"
@@ -0,0 +1,194 @@
+from collections import OrderedDict
+import encoding
+from flask import current_app
+import threading
+import time
+
+# Read-through cache for the DAO read functions. Every entry depends on a set of tags, such as
+# "post:5", "user:3" or "posts" (any list of posts), and remembers the version each tag had
+# before its value was computed. The write paths, through db.commitChanges, call invalidate() with
+# the tags they touched after committing, which bumps those versions, so stale entries are never
+# served again and everything else stays cached.
+#
+# Entries live in a bounded in-process LRU with a TTL. app.config["CACHE_BACKEND"] adds a
+# shared store behind it: "local" (default) keeps everything in process, "shared" uses a
+# LocalSharedStore stand-in, "redis" uses the redis server at CACHE_REDIS_URL and "none" turns
+# caching off. With a shared store the tag versions live there too, so every process sees the
+# invalidations of every other one.
+
+MAX_ENTRIES = 2048
+TTL = 60 # seconds
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRU:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# the subset of redis the cache uses; values are bytes
+class LocalSharedStore:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                return None
+            return entry[0]
+
+    def mget(self, keys):
+        return [self.get(k) for k in keys]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value, None if ex is None else time.monotonic() + ex)
+
+    def incr(self, key):
+        with self.lock:
+            value = int(self.values.get(key, (0, None))[0]) + 1
+            self.values[key] = (str(value).encode(), None)
+            return value
+
+
+class Cache:
+    def __init__(self, shared=None, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.local = LRU(max_entries, ttl)
+        self.shared = shared
+        self.ttl = ttl
+        self.tagVersions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def versions(self, tags):
+        if self.shared is not None:
+            return {t: int(v or 0) for t, v in zip(tags, self.shared.mget([f"tag:{t}" for t in tags]))}
+        with self.lock:
+            return {t: self.tagVersions.get(t, 0) for t in tags}
+
+    def lookup(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            stored = self.shared.get(f"entry:{key}")
+            if stored is not None:
+                entry = encoding.loads(stored)
+                self.local.set(key, entry)
+        return entry
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # the cached value of key, or compute() stored under key when it is missing or stale.
+    # None results are not cached.
+    def fetch(self, key, tags, compute):
+        versions = self.versions(tags)
+        entry = self.lookup(key)
+        if entry is not None and entry[1] == versions:
+            self.count(True)
+            return entry[0]
+        self.count(False)
+        value = compute()
+        if value is not None:
+            entry = [value, versions]
+            self.local.set(key, entry)
+            if self.shared is not None:
+                self.shared.set(f"entry:{key}", encoding.dumps(entry), ex=self.ttl)
+        return value
+
+    # call after the change is committed
+    def invalidate(self, *tags):
+        with self.lock:
+            self.invalidations += 1
+            if self.shared is None:
+                for t in tags:
+                    self.tagVersions[t] = self.tagVersions.get(t, 0) + 1
+        if self.shared is not None:
+            for t in tags:
+                self.shared.incr(f"tag:{t}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self.local.entries)
+            }
+
+
+# stands in for Cache when caching is off
+class NoCache(Cache):
+    def fetch(self, key, tags, compute):
+        self.count(False)
+        return compute()
+
+    def invalidate(self, *tags):
+        pass
+
+
+# the tags of the entries that serialize the given posts and users; any changed post also
+# changes every list of posts
+def tagsFor(post_ids=(), user_ids=()):
+    tags = [f"post:{i}" for i in post_ids] + [f"user:{i}" for i in user_ids]
+    return tags + ["posts"] if post_ids else tags
+
+def key(*parts):
+    return "|".join(",".join(map(str, p)) if isinstance(p, (list, tuple)) else str(p) for p in parts)
+
+def init_app(app):
+    backend = app.config.get("CACHE_BACKEND", "local")
+    ttl = app.config.get("CACHE_TTL", TTL)
+    if backend == "local":
+        cache = Cache(ttl=ttl)
+    elif backend == "shared":
+        cache = Cache(LocalSharedStore(), ttl=ttl)
+    elif backend == "redis":
+        if redis is None:
+            raise ValueError("CACHE_BACKEND=redis needs the redis package")
+        cache = Cache(redis.Redis.from_url(app.config["CACHE_REDIS_URL"]), ttl=ttl)
+    elif backend == "none":
+        cache = NoCache()
+    else:
+        raise ValueError(f"Unknown cache backend {backend}")
+    app.extensions["cache"] = cache
+
+def current():
+    return current_app.extensions["cache"]
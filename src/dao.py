@@ -1,14 +1,88 @@
-from db import db, User, Post, Tag, Comment, Rating, Asset
-from sqlalchemy import func
+from db import db, User, Post, Tag, Comment, Rating, Asset, AssetVariant, followers, timelines, maskFor
+from db import POST_FIELDS, USER_FIELDS, chunked, commitChanges, lockSalt, readonly
+from pagination import paginate, paginateOffset
+import cache
+import ingredients
+import logging
+import search
+import storage
+import timeline
+import uploads
+from sqlalchemy import case, exists, func, select
+from sqlalchemy.orm import joinedload
 import datetime
 
-def getUsers():
-    return [u.serialize() for u in User.query.all()]
+logger = logging.getLogger(__name__)
 
-def getUser(user_id):
-    user = User.query.filter_by(id=user_id).first()
-    return None if (user is None) else user.serialize()
+# keyset orderings used by the paginated list endpoints
+POST_ORDER = (Post.dateTime, Post.id) # newest first
+USER_ORDER = (User.id,)
+RATING_ORDER = (Rating.post_id, Rating.user_id)
+POPULAR_ORDER = (Post.popularity, Post.id) # most popular first
+TIMELINE_ORDER = (timelines.c.dateTime, timelines.c.postID)
+
+MAX_BATCH_SIZE = 100 # ids per /posts/batch/ or /users/batch/ request
+
+def isPaginated(limit, after):
+    return not (limit is None and after is None)
+
+def serializePage(query, columns, limit, after, descending=False, serializeAll=None, keys=None):
+    rows, nextCursor = paginate(query, columns, limit=limit, after=after, descending=descending, keys=keys)
+    items = [r.serialize() for r in rows] if serializeAll is None else serializeAll(rows)
+    return {"items": items, "next_cursor": nextCursor}
+
+def postQuery(fields=POST_FIELDS):
+    return Post.query.options(*Post.loadOptions(fields))
+
+def serializePosts(posts, fields=POST_FIELDS):
+    return [p.serialize(fields) for p in posts]
 
+# narrows a post query to the given tags, price and difficulty; None means no filter
+def applyFilters(posts, tags=None, price=None, difficulty=None):
+    mask = maskFor(tags)
+    if mask:
+        posts = posts.filter(Post.tagMask.op("&")(mask) == mask)
+    if price is not None:
+        posts = posts.filter(Post.priceRating == price)
+    if difficulty is not None:
+        posts = posts.filter(Post.difficultyRating == difficulty)
+    return posts
+
+@readonly
+def getUsers(limit=None, after=None, fields=USER_FIELDS, postFields=POST_FIELDS):
+    users = User.query.options(*User.loadOptions(fields))
+    serializeAll = lambda rows: User.serializeAll(rows, fields, postFields)
+    if isPaginated(limit, after):
+        return serializePage(users, USER_ORDER, limit, after, serializeAll=serializeAll)
+    return serializeAll(users.all())
+
+# existence checks for the write routes; unlike getUser and getPost they are neither readonly nor
+# cached, so they see what the previous request wrote even while the replicas lag
+def userExists(user_id):
+    return db.session.query(exists().where(User.id == user_id)).scalar()
+
+def postExists(post_id):
+    return db.session.query(exists().where(Post.id == post_id)).scalar()
+
+@readonly
+def getUser(user_id, fields=USER_FIELDS, postFields=POST_FIELDS):
+    def load():
+        user = User.query.options(*User.loadOptions(fields)).filter_by(id=user_id).first()
+        return None if (user is None) else user.serialize(fields=fields, postFields=postFields)
+    return cache.current().fetch(cache.key("user", user_id, fields, postFields), [f"user:{user_id}"], load)
+
+# the batch reads load every id with one IN query and answer in request order; ids that do not
+# exist are listed in "missing"
+def batchResult(ids, found):
+    return {"items": [found[i] for i in ids if i in found], "missing": [i for i in ids if i not in found]}
+
+@readonly
+def getUsersByIds(ids, fields=USER_FIELDS, postFields=POST_FIELDS):
+    ids = list(dict.fromkeys(ids))
+    users = User.query.options(*User.loadOptions(fields)).filter(User.id.in_(ids)).all()
+    return batchResult(ids, {u.id: s for u, s in zip(users, User.serializeAll(users, fields, postFields))})
+
+# read on the primary: register() relies on it to keep usernames unique
 def getUserByUsername(username):
     user = User.query.filter_by(username=username).first()
     return None if (user is None) else user.serialize()
@@ -24,146 +98,223 @@ def register(username, password, bio):
 def follow(follower_user_id, followed_user_id):
     follower_user = User.query.filter_by(id=follower_user_id).first()
     follower_user.follow(followed_user_id)
-    db.session.commit()
+    if timeline.enabled():
+        timeline.backfill(follower_user_id, followed_user_id)
+    commitChanges(user_ids=[follower_user_id, followed_user_id])
     return follower_user.serialize()
 
 def unfollow(follower_user_id, followed_user_id):
     follower_user = User.query.filter_by(id=follower_user_id).first()
     follower_user.unfollow(followed_user_id)
-    db.session.commit()
+    if timeline.enabled():
+        timeline.prune(follower_user_id, followed_user_id)
+    commitChanges(user_ids=[follower_user_id, followed_user_id])
     return follower_user.serialize()
 
+# the versions an ETag is built from, read without loading or serializing anything; None when
+# the post or user does not exist
+@readonly
+def postVersion(post_id):
+    return db.session.query(Post.version).filter_by(id=post_id).scalar()
+
+@readonly
+def userVersion(user_id):
+    return db.session.query(User.version).filter_by(id=user_id).scalar()
+
+# a following feed changes when its reader follows or unfollows someone, which bumps the reader,
+# or when a post of anyone they follow changes, which bumps that author. Versions only grow, so
+# the sum over the followed users changes whenever any of them does.
+@readonly
+def feedVersion(user_id):
+    version = userVersion(user_id)
+    if version is None:
+        return None
+    total, count = db.session.query(func.coalesce(func.sum(User.version), 0), func.count(User.id)) \
+        .select_from(followers).join(User, User.id == followers.c.followedID) \
+        .filter(followers.c.followerID == user_id).one()
+    return (version, total, count)
+
+@readonly
 def getFollowingUsernames(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return None
     return [u.username for u in user.followed]
 
+@readonly
 def getFollowersUsernames(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return None
     return user.getFollowersUsernames()
 
-def getFollowingPostsByTags(user_id, **kwargs):
-    tags = kwargs.get("tags")
-    price = kwargs.get("price")
-    difficulty = kwargs.get("difficulty")
-
-    following = getFollowingUsernames(user_id)
-    if following is None:
+@readonly
+def getFollowingPostsByTags(user_id, limit=None, after=None, fields=POST_FIELDS, **kwargs):
+    if User.query.filter_by(id=user_id).first() is None:
         return None
+    serializeAll = lambda rows: serializePosts(rows, fields)
+
+    if timeline.enabled():
+        posts = applyFilters(timeline.feedQuery(postQuery(fields), user_id), **kwargs)
+        if isPaginated(limit, after):
+            return serializePage(posts, TIMELINE_ORDER, limit, after, descending=True,
+                serializeAll=serializeAll, keys=("dateTime", "id"))
+        return serializeAll(posts.order_by(*TIMELINE_ORDER))
+
+    # posts by everyone user_id follows, filtered and ordered in a single query
+    posts = postQuery(fields).join(followers, followers.c.followedID == Post.userID) \
+        .filter(followers.c.followerID == user_id)
+    posts = applyFilters(posts, **kwargs)
+
+    if isPaginated(limit, after):
+        return serializePage(posts, POST_ORDER, limit, after, descending=True, serializeAll=serializeAll)
+    return serializeAll(posts.order_by(*POST_ORDER))
+
+
+# popularity is the number of ratings, halved for poorly rated posts and boosted for well rated ones.
+# It is stored on Post and kept current by updateOverallRating so /posts/popular/ can ORDER BY it.
+# Takes and returns SQL expressions so it can be evaluated inside an UPDATE.
+def postPopularity(numRatings, averageRating):
+	return case([
+		(averageRating < 2, numRatings / 2.0),
+		(averageRating > 4, numRatings * 1.5)
+	], else_=numRatings)
+
+def averageRating(ratingSum, ratingCount):
+	return case([(ratingCount > 0, ratingSum * 1.0 / ratingCount)], else_=0)
+
+# the cache key of a filtered list: equal filters in any order or spelling share an entry
+def filterKey(name, limit, after, fields, tags=None, price=None, difficulty=None):
+    return cache.key(name, maskFor(tags), price, difficulty, limit, after, fields)
+
+@readonly
+def getPopularPostsbyTags(limit=None, after=None, fields=POST_FIELDS, **kwargs):
+    posts = applyFilters(postQuery(fields), **kwargs)
+    serializeAll = lambda rows: serializePosts(rows, fields)
+    # the whole list can be any size, so only pages are cached
+    if not isPaginated(limit, after):
+        return serializeAll(posts.order_by(*[c.desc() for c in POPULAR_ORDER]))
+    load = lambda: serializePage(posts, POPULAR_ORDER, limit, after, descending=True, serializeAll=serializeAll)
+    return cache.current().fetch(filterKey("popular", limit, after, fields, **kwargs), ["posts"], load)
+
+# recomputes the rating counters, overallRating and popularity of the posts that update targets
+# from their Ratings rows
+def recomputeRatings(update):
+    ratingSum = select([func.coalesce(func.sum(Rating.overallRating), 0)]).where(Rating.post_id == Post.id).as_scalar()
+    ratingCount = select([func.count(Rating.overallRating)]).where(Rating.post_id == Post.id).as_scalar()
+    db.session.execute(update.values(rating_sum=ratingSum, rating_count=ratingCount))
+    average = averageRating(Post.rating_sum, Post.rating_count)
+    db.session.execute(update.values(
+        overallRating=average,
+        popularity=postPopularity(Post.rating_count, average)
+    ))
+
+# one-off fill of the rating counters, overallRating and popularity for ratings written
+# before those columns existed
+def backfillRatings():
+    recomputeRatings(Post.__table__.update())
+    db.session.commit()
 
-    posts = db.session.query(Post)
-    
-    #filter for tags first 
-    if not (tags is None or len(tags)==0):
-        for tag in tags:
-            posts= posts.filter(getattr(Post, tag) == (True))
-    if price is not None:
-        posts = posts.filter_by(priceRating=price)
-    if difficulty is not None: 
-        posts = posts.filter_by(difficultyRating=difficulty)
-    
-    allPosts = []
-    #now filter for following posts only
-    for f in following:
-        followed = User.query.filter_by(username=f).first()
-        followedPosts = posts.filter_by(userID=followed.id)
-        for p in followedPosts:
-            allPosts.append(p)
-
-
-    allPosts.sort(key=lambda x: x.dateTime)
-    return [p.serialize() for p in allPosts]
-
-
-def getPostPopularity(post_id):
-	numRatings = db.session.query(func.count(Rating.overallRating)).filter_by(post_id=post_id).scalar()
-	averageRating = Post.query.filter_by(id=post_id).first().overallRating
-	
-	popularity = numRatings
-	if(averageRating<2):
-		popularity=popularity/2
-	if(averageRating>4):
-		popularity=(popularity*3)/2
-
-	return popularity
-
-def getPopularPostsbyTags(**kwargs):
-    posts = db.session.query(Post)
-    tags = kwargs.get("tags")
-    price = kwargs.get("price")
-    difficulty = kwargs.get("difficulty")
-
-    #if there are no tags, then return all posts sorted by popularity 
-    if(tags is None or len(tags)==0):
-        posts = posts.all()
-        posts.sort(key = lambda x: getPostPopularity(x.id), reverse=True)
-        return [p.serialize() for p in posts]
-
-    #otherwise only return posts that have the given tags, price, or difficulty
-    for tag in tags:
-        posts = posts.filter(getattr(Post, tag) == (True))
-    if price is not None:
-        posts = posts.filter_by(priceRating=price)
-    if difficulty is not None: 
-        posts = posts.filter_by(difficultyRating=difficulty)
-
-    posts = posts.all()
-    posts.sort(key = lambda x: getPostPopularity(x.id), reverse=True)
-    return [p.serialize() for p in posts]
+# the same for the given posts only, e.g. after a bulk import of ratings; the caller commits
+def recomputePostRatings(post_ids):
+    for chunk in chunked(list(post_ids)):
+        recomputeRatings(Post.__table__.update().where(Post.id.in_(chunk)))
 
+# changes every ETag, for changes made outside the write paths such as backfillRatings
+def bumpAllVersions():
+    Post.query.update({Post.version: Post.version + 1}, synchronize_session=False)
+    User.query.update({User.version: User.version + 1}, synchronize_session=False)
+    db.session.commit()
 
 def updateTags(post_id, **kwargs):
     tags = kwargs.get("tags")
-    temp_post = Post.query.filter_by(id=post_id).first()
-    if temp_post is None:
-        return None
-    for t in tags:
-        setattr(temp_post, t, True)
-        # temp_post.tags.append(t)
     post = Post.query.filter_by(id=post_id).first()
-    db.session.commit()
+    if post is None:
+        return None
+    post.tagMask = Post.tagMask.op("|")(maskFor(tags))
+    commitChanges([post_id], [post.userID])
     return post.serialize()
 
-def getPostsByFilters(**kwargs):
+@readonly
+def getPostsByFilters(limit=None, after=None, fields=POST_FIELDS, **kwargs):
     tags = kwargs.get("tags")
     price = kwargs.get("price")
     difficulty = kwargs.get("difficulty")
-    posts = db.session.query(Post)
-    if tags is not None: 
-        for tag in tags:
-            posts = posts.filter(getattr(Post, tag) == (True))
-    if price is not None:
-        posts = posts.filter_by(priceRating=price)
-    if difficulty is not None: 
-        posts = posts.filter_by(difficultyRating=difficulty).all()
-    return [p.serialize() for p in posts]
-
+    posts = applyFilters(postQuery(fields), tags=tags, price=price, difficulty=difficulty)
+    serializeAll = lambda rows: serializePosts(rows, fields)
+    # the whole list can be any size, so only pages are cached
+    if not isPaginated(limit, after):
+        return serializeAll(posts)
+    load = lambda: serializePage(posts, POST_ORDER, limit, after, descending=True, serializeAll=serializeAll)
+    key = filterKey("filter", limit, after, fields, tags=tags, price=price, difficulty=difficulty)
+    return cache.current().fetch(key, ["posts"], load)
+
+# posts matching text, most relevant first, optionally narrowed by the same filters as
+# getPostsByFilters. Always paginated; the cursor is an offset into the ranking.
+@readonly
+def searchPosts(text, limit=None, after=None, fields=POST_FIELDS, **kwargs):
+    match = search.matchQuery(text)
+    if match is None:
+        return {"items": [], "next_cursor": None}
+    posts = applyFilters(search.rankedQuery(postQuery(fields), match), **kwargs)
+    rows, nextCursor = paginateOffset(posts, limit, after)
+    return {"items": serializePosts(rows, fields), "next_cursor": nextCursor}
+
+# posts ranked by the share of their ingredients found in have, best coverage first; each item
+# also lists the ingredients that are still missing
+@readonly
+def cookablePosts(have, limit=None, after=None, fields=POST_FIELDS, **kwargs):
+    have = sorted({t for item in have for t in ingredients.tokens(item)})
+    if not have:
+        return {"items": [], "next_cursor": None}
+    matched = ingredients.matches(have)
+    posts = applyFilters(postQuery(fields).join(matched, matched.c.postID == Post.id), **kwargs) \
+        .order_by((matched.c.matched * 1.0 / Post.ingredientCount).desc(), matched.c.matched.desc(), Post.id)
+    rows, nextCursor = paginateOffset(posts, limit, after)
+    needed = ingredients.ingredientsOf([p.id for p in rows])
+    items = serializePosts(rows, fields)
+    for post, item in zip(rows, items):
+        missing = [i for i in needed[post.id] if i not in have]
+        item["coverage"] = round(1 - len(missing) / len(needed[post.id]), 4)
+        item["missing"] = missing
+    return {"items": items, "next_cursor": nextCursor}
+
+@readonly
 def getPostsByTags(**kwargs):
     tags = kwargs.get("tags")
-    posts = db.session.query(Post)
-    for tag in tags:
-        posts = posts.filter(getattr(Post, tag) == (True))
-
-    posts = posts.all()
+    posts = applyFilters(postQuery(), tags=tags).all()
     return [p.serialize() for p in posts]
 
+# the asset is returned as soon as its row is committed; uploads.py stores the image in the background
 def uploadImage(imageData, imgType, typeId):
-    asset = Asset(image_data=imageData, img_type=imgType, type_id=typeId)
-    if asset is None:
+    try:
+        asset = Asset(image_data=imageData, img_type=imgType, type_id=typeId)
+    except ValueError as e:
+        logger.warning(str(e))
         return None
+    return queueUpload(asset)
+
+# image is a streaming.StreamedImage, already validated
+def uploadStreamedImage(image, imgType, typeId):
+    return queueUpload(Asset(image=image, img_type=imgType, type_id=typeId))
+
+def queueUpload(asset):
     db.session.add(asset)
-    if imgType == "profile":
-        user = User.query.filter_by(id=typeId).first()
-        user.photo.append(asset)
-    elif imgType == "post":
-        post = Post.query.filter_by(id=typeId).first()
-        post.photos.append(asset)
-    db.session.commit()
+    db.session.flush()
+    lockSalt(asset.salt)
+    # a duplicate of an image that is already stored
+    reused = asset.reuse()
+    commitChanges(*asset.owners())
+    if reused:
+        return asset.serialize()
+    if not uploads.submit(asset):
+        if not isinstance(asset.data, bytes):
+            asset.data.close()
+        asset.status = "failed"
+        db.session.commit()
     return asset.serialize()
 
+@readonly
 def getImage(img_id):
     asset = Asset.query.filter_by(id=img_id).first()
     if asset is None:
@@ -171,16 +322,24 @@ def getImage(img_id):
     return asset.serialize()
 
 def deleteImage(img_id):
-    asset = asset = Asset.query.filter_by(id=img_id).first()
+    asset = Asset.query.filter_by(id=img_id).first()
     if asset is None:
         return None
-    salt = asset.salt
-    ext = asset.extension
-    img_filename = f"{salt}.{ext}"
-    asset.delete(img_filename)
+    serialized = asset.serialize()
+    owners = asset.owners()
     db.session.delete(asset)
-    db.session.commit()
-    return asset.serialize()
+    db.session.flush()
+    lockSalt(asset.salt)
+    # the stored object and its variants are removed with its last asset, before the commit
+    # releases the lock, so no new asset can reuse them in between
+    if asset.references() == 0:
+        backend = storage.current()
+        backend.delete(asset.filename())
+        for variant in AssetVariant.query.filter_by(salt=asset.salt):
+            backend.delete(variant.filename())
+            db.session.delete(variant)
+    commitChanges(*owners)
+    return serialized
 
 def post(user_id, **kwargs):
 	post = Post(
@@ -198,36 +357,72 @@ def post(user_id, **kwargs):
 	user.posts.append(post)
 
 	db.session.add(post)
-	db.session.commit()
+	db.session.flush()
+	search.index(post)
+	ingredients.index(post.id, post.ingredients)
+	commitChanges([post.id], [user_id])
+	if timeline.enabled():
+		timeline.fanOut(post)
 
 	return post.serialize()
 
 
-def getPost(post_id):
-    post = Post.query.filter_by(id=post_id).first()
-    return None if (post is None) else post.serialize()
-
-def getPosts():
-    return [p.serialize() for p in Post.query.all()]
-
-def getPostsByUser(user_id):
+@readonly
+def getPost(post_id, fields=POST_FIELDS):
+    def load():
+        post = postQuery(fields).filter_by(id=post_id).first()
+        return None if (post is None) else post.serialize(fields)
+    return cache.current().fetch(cache.key("post", post_id, fields), [f"post:{post_id}"], load)
+
+@readonly
+def getPostsByIds(ids, fields=POST_FIELDS):
+    ids = list(dict.fromkeys(ids))
+    posts = postQuery(fields).filter(Post.id.in_(ids)).all()
+    return batchResult(ids, {p.id: p.serialize(fields) for p in posts})
+
+@readonly
+def getPosts(limit=None, after=None, fields=POST_FIELDS):
+    serializeAll = lambda rows: serializePosts(rows, fields)
+    if isPaginated(limit, after):
+        return serializePage(postQuery(fields), POST_ORDER, limit, after, descending=True, serializeAll=serializeAll)
+    return serializeAll(postQuery(fields).all())
+
+@readonly
+def getPostsByUser(user_id, limit=None, after=None, fields=POST_FIELDS):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return None
-    return user.getPosts()
+    if isPaginated(limit, after):
+        return serializePage(postQuery(fields).filter_by(userID=user_id), POST_ORDER, limit, after,
+            descending=True, serializeAll=lambda rows: serializePosts(rows, fields))
+    return user.getPosts(fields)
 
 
 def deletePost(post_id):
     post = Post.query.filter_by(id=post_id).first()
     if post is None:
         return None
+    if timeline.enabled():
+        timeline.removePost(post_id)
+    author = post.userID
+    # serialized first, since its relationships cannot load once it is deleted
+    serialized = post.serialize()
+    search.remove(post_id)
+    ingredients.remove(post_id)
     db.session.delete(post)
-    db.session.commit()
-    return post.serialize()
+    commitChanges([post_id], [author])
+    return serialized
 
-def getAllRatings():
-    return [r.serialize() for r in Rating.query.all()]
+def ratingQuery():
+    return Rating.query.options(joinedload(Rating.post))
 
+@readonly
+def getAllRatings(limit=None, after=None):
+    if isPaginated(limit, after):
+        return serializePage(ratingQuery(), RATING_ORDER, limit, after)
+    return [r.serialize() for r in ratingQuery().all()]
+
+@readonly
 def getDifficultyRating(post_id):
     return {"difficultyRating": Post.query.filter_by(id=post_id).first().difficultyRating}
 
@@ -236,6 +431,7 @@ def addTag(post_id, tags):
     post.setTag(tags)
 
 
+@readonly
 def getPriceRating(post_id):
 	return {"priceRating": Post.query.filter_by(id=post_id).first().priceRating}
 
@@ -244,6 +440,8 @@ def getPriceRating(post_id):
 def rateOverall(user_id, post_id, score):
 	rating = Rating.query.filter_by(post_id=post_id).filter_by(user_id=user_id).first()
 	if rating is not None:
+		added = 1 if rating.overallRating is None else 0
+		delta = score - (rating.overallRating or 0)
 		rating.overallRating = score
 	else:
 		post = Post.query.filter_by(id=post_id).first()
@@ -251,28 +449,26 @@ def rateOverall(user_id, post_id, score):
 
 		rating = Rating(overallRating=score)
 		rating.post = post
-		rating.user = user
-		user.ratings.append(rating)
+		rating.user = user # back_populates adds it to user.ratings without loading that list
 		db.session.add(rating)
-	
-	db.session.commit()
-	updateOverallRating(post_id)
+		added, delta = 1, score
+
+	updateOverallRating(rating.post, delta, added)
+	commitChanges([post_id], [rating.post.userID])
 	return rating.serialize()
 
+@readonly
 def getOverallRating(post_id):
 	return {"overallRating": Post.query.filter_by(id=post_id).first().overallRating}
 
-def updateOverallRating(post_id):
-	sumOfRatings = db.session.query(func.sum(Rating.overallRating)).filter_by(post_id=post_id).scalar()
-	numRatings = db.session.query(func.count(Rating.overallRating)).filter_by(post_id=post_id).scalar()
-	print(""*3)
-	print("the sum of the overall ratings is: " + str(sumOfRatings))
-	print("the number of overall ratings is: " + str(numRatings))
-	print(""*3)
-
-	post = Post.query.filter_by(id=post_id).first()
-	post.overallRating = sumOfRatings/numRatings
-	db.session.commit()
-
-
-
+# applies one rating change to the post's running totals. The new values are SQL expressions over
+# the stored ones, so the flush is a single UPDATE that stays correct under concurrent votes.
+def updateOverallRating(post, delta, added):
+	ratingSum = Post.rating_sum + delta
+	ratingCount = Post.rating_count + added
+	average = averageRating(ratingSum, ratingCount)
+
+	post.rating_sum = ratingSum
+	post.rating_count = ratingCount
+	post.overallRating = average
+	post.popularity = postPopularity(ratingCount, average)
@@ -1,22 +1,98 @@
-from flask_sqlalchemy import SQLAlchemy
 import base64
-import boto3
+import cache
+from functools import lru_cache, wraps
 import datetime
+import hashlib
 from io import BytesIO
 from mimetypes import guess_extension, guess_type
-import os
 from PIL import Image
-import random
 import re
-import string
+from replicas import RoutingSQLAlchemy
+from sqlalchemy import and_, exists, text
+from sqlalchemy.orm import load_only, selectinload
+import storage
 
 
-db = SQLAlchemy()
+# sends the queries of readonly functions to the read replicas, if any; see replicas.py
+db = RoutingSQLAlchemy()
 
 EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
-S3_BUCKET = "recipeappimages"
-S3_BASE_URL = f"https://{S3_BUCKET}.s3-us-east-2.amazonaws.com"
+
+# tag registry: a tag's bit in Post.tagMask is its position in this list, so new tags are
+# appended here without a schema change and existing tags are never reordered or removed
+TAGS = [
+    "vegan", "vegetarian", "kosher", "glutenFree", "mexican",
+    "asian", "italian", "french", "dessert", "breakfast"
+]
+TAG_BITS = {tag: 1 << i for i, tag in enumerate(TAGS)}
+
+class UnknownTag(ValueError):
+    pass
+
+def maskFor(tags):
+    mask = 0
+    for tag in tags or []:
+        if tag not in TAG_BITS:
+            raise UnknownTag(f"Unknown tag {tag}")
+        mask |= TAG_BITS[tag]
+    return mask
+
+# memoized, so serializing tags is a dictionary lookup per distinct mask
+@lru_cache(maxsize=None)
+def tagNames(mask):
+    return tuple(tag for tag in TAGS if mask & TAG_BITS[tag])
+
+# splits a list of ids so IN clauses stay under SQLite's bound parameter limit
+def chunked(ids, size=500):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+# field projections: a view names a set of serialized fields, "full" being everything serialize()
+# returns. The models load only the columns and relationships the requested fields read.
+POST_FIELDS = ("post_id", "title", "dateTime", "ingredients", "recipe", "recipeTime",
+    "difficultyRating", "overallRating", "priceRating", "user_id", "comments", "tags", "photos")
+POST_VIEWS = {
+    "full": POST_FIELDS,
+    "summary": ("post_id", "title", "dateTime", "recipeTime", "difficultyRating", "overallRating",
+        "priceRating", "user_id", "tags", "photos")
+}
+USER_FIELDS = ("user_id", "username", "bio", "posts", "is_following", "followed_by")
+USER_VIEWS = {
+    "full": USER_FIELDS,
+    "summary": ("user_id", "username", "bio")
+}
+
+class UnknownField(ValueError):
+    pass
+
+# the fields picked by ?view= and ?fields=, a comma separated list that takes precedence
+def selectFields(available, views, view=None, fields=None):
+    if fields:
+        selected = tuple(f.strip() for f in fields.split(",") if f.strip())
+        for f in selected:
+            if f not in available:
+                raise UnknownField(f"Unknown field {f}")
+        return selected
+    if view is None:
+        return available
+    if view not in views:
+        raise UnknownField(f"Unknown view {view}")
+    return views[view]
+
+
+# a resized or re-encoded copy of a stored image, shared by every asset with the same salt
+class AssetVariant(db.Model):
+    __tablename__ = "asset_variants"
+
+    salt = db.Column(db.String, primary_key=True)
+    name = db.Column(db.String, primary_key=True)
+    extension = db.Column(db.String, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+
+    def filename(self):
+        return f"{self.salt}_{self.name}.{self.extension}"
+
 
 # an image or asset
 class Asset(db.Model):
@@ -24,13 +100,20 @@ class Asset(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     img_type = db.Column(db.String, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey("Posts.id"), nullable=True)
-    profile_id = db.Column(db.Integer, db.ForeignKey("Users.id"), nullable=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("Posts.id"), nullable=True, index=True)
+    profile_id = db.Column(db.Integer, db.ForeignKey("Users.id"), nullable=True, index=True)
     base_url = db.Column(db.String, nullable=True)
-    salt = db.Column(db.String, nullable=False)
+    salt = db.Column(db.String, nullable=False, index=True) # sha256 of the image bytes; random for older images
     extension = db.Column(db.String, nullable=False)
     width = db.Column(db.Integer, nullable=False)
     height = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String, nullable=False, default="ready") # pending until uploads.py has stored it
+    created = db.Column(db.DateTime, nullable=True) # NULL for assets added before it was recorded
+    # filled in by uploads.py once the image is stored, see variants.py
+    variants = db.relationship("AssetVariant",
+        primaryjoin="foreign(AssetVariant.salt) == Asset.salt",
+        order_by="AssetVariant.name",
+        viewonly=True)
 
     def __init__(self, **kwargs):
         self.img_type = kwargs.get("img_type")
@@ -39,7 +122,32 @@ class Asset(db.Model):
         elif self.img_type == "post":
             self.post_id = kwargs.get("type_id")
 
-        self.create(kwargs.get("image_data")) # create image
+        self.status = "pending"
+        self.created = datetime.datetime.now()
+        if kwargs.get("image") is not None:
+            self.fromStream(kwargs.get("image")) # image already read by streaming.py
+        else:
+            self.create(kwargs.get("image_data")) # create image
+
+    def filename(self):
+        return f"{self.salt}.{self.extension}"
+
+    # the posts and users whose serialization includes this asset, as (post ids, user ids)
+    def owners(self):
+        if self.post_id is not None:
+            author = db.session.query(Post.userID).filter_by(id=self.post_id).scalar()
+            return [self.post_id], [author]
+        return [], [self.profile_id]
+
+    # number of assets sharing this one's stored object
+    def references(self):
+        return Asset.query.filter_by(salt=self.salt).count()
+
+    def serializeVariants(self):
+        return {
+            v.name: {"url": f"{self.base_url}/{v.filename()}", "width": v.width, "height": v.height}
+            for v in self.variants
+        }
 
     def serialize(self):
         if self.img_type == "post":
@@ -47,88 +155,120 @@ class Asset(db.Model):
             "image_id": self.id,
             "img_type": self.img_type,
             "type_id": self.post_id,
-            "url": f"{self.base_url}/{self.salt}.{self.extension}"
+            "url": f"{self.base_url}/{self.salt}.{self.extension}",
+            "width": self.width,
+            "height": self.height,
+            "status": self.status,
+            "variants": self.serializeVariants()
         }
         return {
             "image_id": self.id,
             "img_type": self.img_type,
             "type_id": self.profile_id,
-            "url": f"{self.base_url}/{self.salt}.{self.extension}"
+            "url": f"{self.base_url}/{self.salt}.{self.extension}",
+            "width": self.width,
+            "height": self.height,
+            "status": self.status,
+            "variants": self.serializeVariants()
         }
         
 
+    # decodes and checks a base64 image, leaving its bytes in self.data for uploads.py to store.
+    # Images are addressed by the hash of their bytes, so every asset with the same salt shares
+    # one stored object; see reuse(). Raises ValueError when image_data is not a supported base64
+    # image.
     def create(self, image_data):
         try:
             # given a base64 string --> .png --> png
-            ext = guess_extension(guess_type(image_data)[0])[1:]
+            content_type = guess_type(image_data)[0]
+            ext = guess_extension(content_type)[1:]
             if ext not in EXTENSIONS:
-                raise Exception(f"Extension {ext} not supported!")
-
-            # secure way of generating random string for image name
-            salt = "".join(
-                random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits
-                )
-                for _ in range(16)
-            )
+                raise ValueError(f"Extension {ext} not supported!")
 
-            # remove header of base64 string and open image
+            # remove header of base64 string
             img_str = re.sub("^data:image/.+;base64,", "", image_data)
             img_data = base64.b64decode(img_str)
+            salt = hashlib.sha256(img_data).hexdigest()
+
+            # read the image size from its header
             img = Image.open(BytesIO(img_data))
 
-            self.base_url = S3_BASE_URL
             self.salt = salt
             self.extension = ext
+            self.base_url = storage.current().base_url
             self.width = img.width
             self.height = img.height
-            
-
-            img_filename = f"{salt}.{ext}"
-            self.upload(img, img_filename)
-
-        except Exception as e:
-            print(f"Unable to create image due to {e}")
-
-    def upload(self, img, img_filename):
-        try:
-            # save image temporariliy on server
-            img_temploc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temploc)
-
-            # upload image to S3
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temploc, S3_BUCKET, img_filename)
-
-            # make S3 image url public
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET, img_filename)
-            object_acl.put(ACL="public-read")
-
-            os.remove(img_temploc)
-
-        except Exception as e:
-            print(f"Unable to upload image due to {e}")
-
-    def delete(self, img_filename): # filename is the salt.ext 
-        s3 = boto3.resource("s3")
-        s3.Object(S3_BUCKET, img_filename).delete()
+            # the original bytes are stored as is, without re-encoding
+            self.data = img_data
+            self.content_type = content_type
+
+        except (TypeError, ValueError, OSError) as e:
+            raise ValueError(f"Unable to create image due to {e}") from e
+
+    # takes a streaming.StreamedImage; self.data is its spooled file
+    def fromStream(self, image):
+        self.salt = image.salt
+        self.extension = image.extension
+        self.base_url = storage.current().base_url
+        self.width = image.width
+        self.height = image.height
+        self.data = image.file
+        self.content_type = image.content_type
+
+    # points this new asset at the stored object of an identical ready image, if there is one,
+    # and drops its own bytes, so nothing is uploaded again. Call it after flushing the asset and
+    # lockSalt(), so the object cannot be deleted before the transaction commits.
+    def reuse(self):
+        stored = Asset.query.filter(Asset.salt == self.salt, Asset.status == "ready", Asset.id != self.id).first()
+        if stored is None:
+            return False
+        self.extension = stored.extension
+        self.base_url = stored.base_url
+        self.width = stored.width
+        self.height = stored.height
+        self.status = "ready"
+        if not isinstance(self.data, bytes):
+            self.data.close()
+        self.data = None
+        return True
 
 
 # must be here, before User model
 followers = db.Table("Followers",
     db.Column("followerID", db.Integer, db.ForeignKey("Users.id")),
-    db.Column("followedID", db.Integer, db.ForeignKey("Users.id"))
+    db.Column("followedID", db.Integer, db.ForeignKey("Users.id")),
+    db.Index("ix_Followers_followerID_followedID", "followerID", "followedID", unique=True),
+    db.Index("ix_Followers_followedID", "followedID", "followerID")
+    )
+
+# precomputed following feeds, one row per (reader, post); maintained by timeline.py
+timelines = db.Table("Timelines",
+    db.Column("userID", db.Integer, db.ForeignKey("Users.id"), primary_key=True),
+    db.Column("postID", db.Integer, db.ForeignKey("Posts.id"), primary_key=True),
+    db.Column("authorID", db.Integer, db.ForeignKey("Users.id"), nullable=False),
+    db.Column("dateTime", db.DateTime, nullable=False),
+    db.Index("ix_Timelines_userID_dateTime", "userID", "dateTime", "postID")
+    )
+
+# inverted index from normalized ingredient to the posts that use it; maintained by ingredients.py
+ingredientPostings = db.Table("IngredientPostings",
+    db.Column("ingredient", db.String, primary_key=True),
+    db.Column("postID", db.Integer, db.ForeignKey("Posts.id"), primary_key=True),
+    db.Index("ix_IngredientPostings_postID", "postID")
     )
 
 
 class User(db.Model):
     __tablename__ = "Users"
+    __table_args__ = (
+        db.Index("ix_Users_username", "username", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     username = db.Column(db.String, nullable=False)
     password = db.Column(db.String, nullable=False)
     bio = db.Column(db.String)
+    version = db.Column(db.Integer, nullable=False, default=1) # bumped by commitChanges, see app.etag
 
     posts = db.relationship("Post", cascade="delete")
     comments = db.relationship("Comment", cascade="delete")
@@ -154,31 +294,92 @@ class User(db.Model):
             self.followed.remove(followed_user)
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followedID == user.id).count() > 0
+        edge = and_(followers.c.followerID == self.id, followers.c.followedID == user.id)
+        return db.session.query(exists().where(edge)).scalar()
 
 
     def getUser(self, user_id):
         return User.query.filter_by(id=user_id).first()
     
-    def getPosts(self):
-        return [p.serialize() for p in self.posts]
+    def getPosts(self, fields=POST_FIELDS):
+        return [p.serialize(fields) for p in Post.query.options(*Post.loadOptions(fields)).filter_by(userID=self.id)]
 
     def getFollowersUsernames(self):
-        return [self.getUser(u.followerID).username for u in db.session.query(followers).filter(followers.c.followedID==self.id).all()]
-
-    def serialize(self):
-        return {
-            "user_id": self.id,
-            "username": self.username,
-            "bio": self.bio,
-            "posts": [p.serialize() for p in self.posts],
-            "is_following": [u.username for u in self.followed],
-            "followed_by": self.getFollowersUsernames()
+        return User.followUsernames([self.id])[1][self.id]
+
+    # the usernames each user follows and is followed by, one query per direction for the whole list
+    @staticmethod
+    def followUsernames(user_ids):
+        following = {i: [] for i in user_ids}
+        followedBy = {i: [] for i in user_ids}
+        for chunk in chunked(user_ids):
+            rows = db.session.query(followers.c.followerID, User.username) \
+                .select_from(followers).join(User, User.id == followers.c.followedID) \
+                .filter(followers.c.followerID.in_(chunk))
+            for user_id, username in rows:
+                following[user_id].append(username)
+            rows = db.session.query(followers.c.followedID, User.username) \
+                .select_from(followers).join(User, User.id == followers.c.followerID) \
+                .filter(followers.c.followedID.in_(chunk))
+            for user_id, username in rows:
+                followedBy[user_id].append(username)
+        return following, followedBy
+
+    # every post of every user, with comments, photos and their variants, in four queries
+    @staticmethod
+    def postsByUser(user_ids, fields=POST_FIELDS):
+        posts = {i: [] for i in user_ids}
+        for chunk in chunked(user_ids):
+            query = Post.query.options(*Post.loadOptions(fields)).filter(Post.userID.in_(chunk)).order_by(Post.id)
+            for p in query:
+                posts[p.userID].append(p)
+        return posts
+
+    # loads only the columns the fields read, see USER_FIELDS
+    @staticmethod
+    def loadOptions(fields=USER_FIELDS):
+        columns = {"user_id": User.id, "username": User.username, "bio": User.bio}
+        return [load_only(User.id, *[columns[f] for f in fields if f in columns])]
+
+    # serializes a list of users in a fixed number of queries, however many posts and followers
+    # they have; posts and follows are only queried when the fields include them
+    @staticmethod
+    def serializeAll(users, fields=USER_FIELDS, postFields=POST_FIELDS):
+        ids = [u.id for u in users]
+        posts = User.postsByUser(ids, postFields) if "posts" in fields else {}
+        following, followedBy = {}, {}
+        if "is_following" in fields or "followed_by" in fields:
+            following, followedBy = User.followUsernames(ids)
+        return [
+            u.serialize(posts.get(u.id, []), following.get(u.id, []), followedBy.get(u.id, []), fields, postFields)
+            for u in users
+        ]
+
+    def serialize(self, posts=None, following=None, followedBy=None, fields=USER_FIELDS, postFields=POST_FIELDS):
+        if posts is None or following is None or followedBy is None:
+            return User.serializeAll([self], fields, postFields)[0]
+        values = {
+            "user_id": lambda: self.id,
+            "username": lambda: self.username,
+            "bio": lambda: self.bio,
+            "posts": lambda: [p.serialize(postFields) for p in posts],
+            "is_following": lambda: following,
+            "followed_by": lambda: followedBy
         }
+        return {f: values[f]() for f in fields}
 
 
 class Post(db.Model):
     __tablename__ = "Posts"
+    __table_args__ = (
+        db.Index("ix_Posts_popularity", "popularity", "id"),
+        db.Index("ix_Posts_dateTime", "dateTime", "id"),
+        db.Index("ix_Posts_userID_dateTime", "userID", "dateTime", "id"),
+        db.Index("ix_Posts_priceRating_difficultyRating", "priceRating", "difficultyRating"),
+        # only the posts that are not in the ingredient index yet
+        db.Index("ix_Posts_unindexed", "id", sqlite_where=db.text('"ingredientCount" IS NULL'),
+            postgresql_where=db.text('"ingredientCount" IS NULL'))
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     title = db.Column(db.String, nullable=False)
@@ -190,8 +391,13 @@ class Post(db.Model):
     ratings = db.relationship("Rating", back_populates="post")
     
     difficultyRating = db.Column(db.Integer, nullable=False)
-    overallRating = db.Column(db.Integer, nullable=False)
+    overallRating = db.Column(db.Float, nullable=False) # rating_sum / rating_count
     priceRating = db.Column(db.Integer, nullable=False)
+    popularity = db.Column(db.Float, nullable=False, default=0) # see dao.postPopularity
+
+    # running totals of the overall ratings, updated by delta in dao.updateOverallRating
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
 
 
     userID = db.Column(db.Integer, db.ForeignKey("Users.id"))
@@ -199,68 +405,65 @@ class Post(db.Model):
     comments = db.relationship("Comment", cascade="delete")
     photos = db.relationship("Asset", cascade="delete")
 
-    # tags
-    # tags array to keep track more easily?
-    vegan = db.Column(db.Boolean, nullable=False, default=False)
-    vegetarian = db.Column(db.Boolean, nullable=False, default=False)
-    kosher = db.Column(db.Boolean, nullable=False, default=False)
-    glutenFree = db.Column(db.Boolean, nullable=False, default=False)
-    mexican = db.Column(db.Boolean, nullable=False, default=False)
-    asian = db.Column(db.Boolean, nullable=False, default=False)
-    italian = db.Column(db.Boolean, nullable=False, default=False)
-    french = db.Column(db.Boolean, nullable=False, default=False)
-    dessert = db.Column(db.Boolean, nullable=False, default=False)
-    breakfast = db.Column(db.Boolean, nullable=False, default=False)
-
+    # bit i is set when the post has TAGS[i]
+    # not indexed: no index can answer tagMask & m = m, so tag filters ride the dateTime or popularity index
+    tagMask = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1) # bumped by commitChanges, see app.etag
+    # number of distinct ingredients in the IngredientPostings index, NULL until indexed
+    ingredientCount = db.Column(db.Integer)
+
+
+    # loads only the columns the fields read, plus the pagination keys, and eagerly loads the
+    # relationships they walk, so a list of full posts costs four queries and summaries two
+    @staticmethod
+    def loadOptions(fields=POST_FIELDS):
+        columns = {
+            "post_id": [], "title": [Post.title], "dateTime": [], "ingredients": [Post.ingredients],
+            "recipe": [Post.recipe], "recipeTime": [Post.recipeTime],
+            "difficultyRating": [Post.difficultyRating], "overallRating": [Post.overallRating],
+            "priceRating": [Post.priceRating], "user_id": [], "comments": [], "tags": [Post.tagMask],
+            "photos": []
+        }
+        options = [load_only(Post.id, Post.userID, Post.dateTime, Post.popularity,
+            *[c for f in fields for c in columns[f]])]
+        if "comments" in fields:
+            options.append(selectinload(Post.comments))
+        if "photos" in fields:
+            options.append(selectinload(Post.photos).selectinload(Asset.variants))
+        return options
 
     def trueTags(self):
-        trueTags = []
-        if self.vegan:
-            trueTags.append("vegan")
-        if self.vegetarian:
-            trueTags.append("vegetarian")
-        if self.kosher:
-            trueTags.append("kosher")
-        if self.glutenFree:
-            trueTags.append("glutenFree")
-        if self.mexican:
-            trueTags.append("mexican")
-        if self.asian:
-            trueTags.append("asian")
-        if self.italian:
-            trueTags.append("italian")
-        if self.french:
-            trueTags.append("french")
-        if self.dessert:
-            trueTags.append("dessert")
-        if self.breakfast:
-            trueTags.append("breakfast")
-        return trueTags
-
-    def serialize(self):
-        return {
-            "post_id": self.id, 
-            "title": self.title, 
-            "dateTime": self.dateTime.strftime("%b-%d-%Y-%H:%M"),
-            "ingredients": self.ingredients, 
-            "recipe": self.recipe, 
-            "recipeTime": self.recipeTime, 
+        return list(tagNames(self.tagMask or 0))
+
+    # fields is a projection from POST_FIELDS; only the attributes it names are read
+    def serialize(self, fields=POST_FIELDS):
+        values = {
+            "post_id": lambda: self.id, 
+            "title": lambda: self.title, 
+            "dateTime": lambda: self.dateTime.strftime("%b-%d-%Y-%H:%M"),
+            "ingredients": lambda: self.ingredients, 
+            "recipe": lambda: self.recipe, 
+            "recipeTime": lambda: self.recipeTime, 
             
-            "difficultyRating": self.difficultyRating,
-            "overallRating": self.overallRating, 
-            "priceRating": self.priceRating, 
+            "difficultyRating": lambda: self.difficultyRating,
+            "overallRating": lambda: self.overallRating, 
+            "priceRating": lambda: self.priceRating, 
 
-            "user_id": self.userID,
-            "comments": [c.serialize(view="post") for c in self.comments],
-            "tags": self.trueTags(),
+            "user_id": lambda: self.userID,
+            "comments": lambda: [c.serialize() for c in self.comments],
+            "tags": lambda: self.trueTags(),
 
-            "photos": [p.serialize() for p in self.photos]
+            "photos": lambda: [p.serialize() for p in self.photos]
         }
+        return {f: values[f]() for f in fields}
 
 
 #users to posts many to many relationship that reflects the ratings a user gives to a post
 class Rating(db.Model):
 	__tablename__ = "Ratings"
+	__table_args__ = (
+		db.Index("ix_Ratings_user_id", "user_id"),
+	)
 	
 	post_id = db.Column(db.Integer, db.ForeignKey("Posts.id"), primary_key=True)
 	user_id = db.Column(db.Integer, db.ForeignKey("Users.id"), primary_key=True)
@@ -292,7 +495,7 @@ class Comment(db.Model):
     comment = db.Column(db.Integer, nullable=False)
 
     userID = db.Column(db.Integer, db.ForeignKey("Users.id"))
-    postID = db.Column(db.Integer, db.ForeignKey("Posts.id"))
+    postID = db.Column(db.Integer, db.ForeignKey("Posts.id"), index=True)
 
     def serialize(self):
         return {
@@ -317,3 +520,42 @@ class Tag(db.Model):
         "tag": self.tag, 
         "post_id": self.postID
         }
+
+
+# runs function with its queries sent to a read replica, unless the session already wrote; for
+# DAO functions that only read
+def readonly(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        info = db.session.info
+        outer = info.get("readonly", False)
+        info["readonly"] = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            info["readonly"] = outer
+    return wrapper
+
+# Until the transaction ends, blocks the other transactions that call it for the same salt. Adding
+# and removing assets take it, so an asset never reuses a stored object that is being deleted,
+# and the last reference to an object is never removed while another one is added. PostgreSQL
+# takes an advisory lock; SQLite runs one writing transaction at a time, so there the caller must
+# already have written in this transaction.
+def lockSalt(salt):
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:salt))"), {"salt": salt})
+
+# Commits the current transaction after bumping the version of every given post and user whose
+# serialization it changes, then invalidates their cache entries. A user's serialization embeds
+# their posts, so the author of a changed post is always passed too.
+def commitChanges(post_ids=(), user_ids=()):
+    post_ids = sorted(set(i for i in post_ids if i is not None))
+    user_ids = sorted(set(i for i in user_ids if i is not None))
+    for chunk in chunked(post_ids):
+        Post.query.filter(Post.id.in_(chunk)) \
+            .update({Post.version: Post.version + 1}, synchronize_session=False)
+    for chunk in chunked(user_ids):
+        User.query.filter(User.id.in_(chunk)) \
+            .update({User.version: User.version + 1}, synchronize_session=False)
+    db.session.commit()
+    cache.current().invalidate(*cache.tagsFor(post_ids, user_ids))
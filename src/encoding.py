@@ -0,0 +1,60 @@
+import gzip
+import json
+import os
+from flask import request
+
+# JSON encoding for responses and request bodies. orjson is used when it is installed and the
+# standard library otherwise; JSON_BACKEND=json in the environment forces the fallback. Both
+# backends produce bytes. init_app() gzips JSON responses larger than COMPRESS_MIN_SIZE for
+# clients that accept it.
+
+COMPRESS_MIN_SIZE = 1024 # bytes; smaller bodies are not worth the cpu
+COMPRESS_LEVEL = 5
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def jsonDumps(obj):
+    return json.dumps(obj).encode()
+
+def orjsonDumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+BACKENDS = {"json": (jsonDumps, json.loads)}
+if orjson is not None:
+    BACKENDS["orjson"] = (orjsonDumps, orjson.loads)
+
+backend = os.environ.get("JSON_BACKEND", "orjson" if orjson is not None else "json")
+dumps, loads = BACKENDS[backend]
+
+
+# switches every encode and decode to one of BACKENDS
+def use(name):
+    global backend, dumps, loads
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend {name} is not available")
+    backend = name
+    dumps, loads = BACKENDS[name]
+
+def requestBody():
+    return loads(request.get_data())
+
+def compress(response):
+    if (response.mimetype != "application/json"
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or "gzip" not in request.accept_encodings):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+def init_app(app):
+    app.after_request(compress)
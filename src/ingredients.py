@@ -0,0 +1,93 @@
+from db import db, Post, chunked, ingredientPostings
+import re
+from sqlalchemy import bindparam, func
+
+# "What can I cook": Post.ingredients is parsed into normalized ingredient tokens stored in the
+# IngredientPostings inverted index (ingredient -> post ids), and Post.ingredientCount records
+# how many distinct ingredients each recipe needs. Ranking looks up the posting lists of the
+# ingredients a student has and counts, per post, how many of them it uses, so only posts that
+# share at least one ingredient are ever read.
+
+UNITS = {
+    "cup", "cups", "tbsp", "tablespoon", "tablespoons", "tsp", "teaspoon", "teaspoons",
+    "g", "gram", "grams", "kg", "oz", "ounce", "ounces", "lb", "lbs", "pound", "pounds",
+    "ml", "l", "liter", "liters", "litre", "litres", "pinch", "dash", "clove", "cloves",
+    "slice", "slices", "can", "cans", "package", "packages", "handful", "piece", "pieces"
+}
+STOPWORDS = {
+    "a", "an", "of", "and", "or", "to", "taste", "fresh", "chopped", "diced", "sliced",
+    "minced", "large", "small", "medium", "some", "optional", "for", "the", "about"
+}
+SEPARATORS = re.compile(r"[,;\n]|\band\b")
+BATCH_SIZE = 500
+
+
+def singular(word):
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("oes") and len(word) > 4:
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+# "2 cups of Rice, 3 large eggs" -> ["egg", "rice"]
+def tokens(text):
+    found = set()
+    for item in SEPARATORS.split((text or "").lower()):
+        words = [singular(w) for w in re.findall(r"[a-z]+", item) if w not in UNITS and w not in STOPWORDS]
+        if words:
+            found.add(" ".join(words))
+    return sorted(found)
+
+# replaces the postings of post_id; call inside the transaction that writes the post
+def index(post_id, text):
+    remove(post_id)
+    found = tokens(text)
+    if found:
+        db.session.execute(ingredientPostings.insert(), [{"ingredient": t, "postID": post_id} for t in found])
+    Post.query.filter_by(id=post_id).update({Post.ingredientCount: len(found)}, synchronize_session=False)
+
+def remove(post_id):
+    db.session.execute(ingredientPostings.delete().where(ingredientPostings.c.postID == post_id))
+
+# indexes posts that have no postings yet, given as (id, ingredients) pairs, with one
+# executemany insert and one executemany update
+def indexNew(posts):
+    postings, counts = [], []
+    for post_id, text in posts:
+        found = tokens(text)
+        postings.extend({"ingredient": t, "postID": post_id} for t in found)
+        counts.append({"post": post_id, "count": len(found)})
+    if postings:
+        db.session.execute(ingredientPostings.insert(), postings)
+    if counts:
+        db.session.execute(Post.__table__.update().where(Post.id == bindparam("post"))
+            .values(ingredientCount=bindparam("count")), counts)
+
+# indexes every post that is not indexed yet, BATCH_SIZE posts per transaction
+def indexAll():
+    while True:
+        posts = db.session.query(Post.id, Post.ingredients).filter(Post.ingredientCount.is_(None)) \
+            .order_by(Post.id).limit(BATCH_SIZE).all()
+        if not posts:
+            return
+        indexNew(posts)
+        db.session.commit()
+
+# a subquery of (postID, matched) for every post using at least one of have
+def matches(have):
+    return db.session.query(
+        ingredientPostings.c.postID.label("postID"),
+        func.count(ingredientPostings.c.ingredient).label("matched")
+    ).filter(ingredientPostings.c.ingredient.in_(have)).group_by(ingredientPostings.c.postID).subquery()
+
+# the ingredients of each of post_ids
+def ingredientsOf(post_ids):
+    found = {i: [] for i in post_ids}
+    for chunk in chunked(post_ids):
+        rows = db.session.query(ingredientPostings.c.postID, ingredientPostings.c.ingredient) \
+            .filter(ingredientPostings.c.postID.in_(chunk)).order_by(ingredientPostings.c.ingredient)
+        for post_id, ingredient in rows:
+            found[post_id].append(ingredient)
+    return found
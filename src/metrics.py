@@ -0,0 +1,210 @@
+import cache
+from collections import Counter
+import encoding
+from flask import g, has_request_context, request
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
+import time
+
+# Per-request instrumentation, cheap enough to leave on: a before/after_request pair times each
+# request, SQLAlchemy cursor events count and time its statements, and dumps() times the final
+# JSON encoding of its response. The DAO serialize functions that build the response data are
+# not included; their time only shows in the request duration. The totals are kept per route in process and rendered by render() in
+# the Prometheus text format for /metrics. A request that runs the same statement N_PLUS_ONE
+# times or more is counted, and logged once per route and statement, as an N+1 suspect.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100) # statements per request
+N_PLUS_ONE = 5
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+# what one request did so far, kept in flask.g
+class RequestStats:
+    __slots__ = ("start", "queries", "dbTime", "encodeTime", "statements")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.dbTime = 0.0
+        self.encodeTime = 0.0
+        self.statements = Counter()
+
+
+class RouteStats:
+    def __init__(self):
+        self.statuses = Counter()
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.dbTime = 0.0
+        self.encodeTime = 0.0
+        self.responseBytes = 0
+        self.suspects = 0
+
+
+class Registry:
+    def __init__(self):
+        self.routes = {}
+        self.reported = set() # (route, statement) pairs already logged as N+1 suspects
+        self.lock = threading.Lock()
+
+    def record(self, route, status, stats, size):
+        duration = time.perf_counter() - stats.start
+        repeated = [s for s, n in stats.statements.items() if n >= N_PLUS_ONE]
+        with self.lock:
+            routeStats = self.routes.get(route)
+            if routeStats is None:
+                routeStats = self.routes[route] = RouteStats()
+            routeStats.statuses[status] += 1
+            routeStats.duration.observe(duration)
+            routeStats.queries.observe(stats.queries)
+            routeStats.dbTime += stats.dbTime
+            routeStats.encodeTime += stats.encodeTime
+            routeStats.responseBytes += size
+            if repeated:
+                routeStats.suspects += 1
+            unreported = [s for s in repeated if (route, s) not in self.reported]
+            self.reported.update((route, s) for s in unreported)
+        for statement in unreported:
+            logger.warning(f"Possible N+1 in {route[1]} {route[0]}: ran {stats.statements[statement]} times: {statement[:200]}")
+
+    def render(self):
+        lines = []
+        with self.lock:
+            routes = sorted(self.routes.items())
+            for name, kind, description in METRICS:
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (rule, method), routeStats in routes:
+                    labels = f'route="{escape(rule)}",method="{method}"'
+                    lines.extend(RENDER[name](routeStats, name, labels))
+        return "\n".join(lines + cacheLines()) + "\n"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+METRICS = [
+    ("http_requests_total", "counter", "Requests by route, method and status."),
+    ("http_request_duration_seconds", "histogram", "Time from the start of a request to its response."),
+    ("db_queries_per_request", "histogram", "SQL statements run by a request."),
+    ("db_query_seconds_total", "counter", "Time spent running SQL statements."),
+    ("json_encode_seconds_total", "counter", "Time spent encoding response data as JSON."),
+    ("http_response_bytes_total", "counter", "Response body bytes, after compression."),
+    ("n_plus_one_suspects_total", "counter", f"Requests that ran one statement {N_PLUS_ONE} or more times.")
+]
+RENDER = {
+    "http_requests_total": lambda r, name, labels:
+        [f'{name}{{{labels},status="{status}"}} {n}' for status, n in sorted(r.statuses.items())],
+    "http_request_duration_seconds": lambda r, name, labels: r.duration.render(name, labels),
+    "db_queries_per_request": lambda r, name, labels: r.queries.render(name, labels),
+    "db_query_seconds_total": lambda r, name, labels: [f"{name}{{{labels}}} {r.dbTime}"],
+    "json_encode_seconds_total": lambda r, name, labels: [f"{name}{{{labels}}} {r.encodeTime}"],
+    "http_response_bytes_total": lambda r, name, labels: [f"{name}{{{labels}}} {r.responseBytes}"],
+    "n_plus_one_suspects_total": lambda r, name, labels: [f"{name}{{{labels}}} {r.suspects}"]
+}
+
+def cacheLines():
+    lines = []
+    for key, value in cache.current().stats().items():
+        kind = "gauge" if key == "entries" else "counter"
+        name = f"cache_{key}" if kind == "gauge" else f"cache_{key}_total"
+        lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+    return lines
+
+registry = Registry()
+
+
+# the stats of the current request, or None outside requests and when metrics are off
+def current():
+    if not has_request_context():
+        return None
+    return g.get("metrics")
+
+def beforeRequest():
+    g.metrics = RequestStats()
+
+def afterRequest(response):
+    stats = current()
+    if stats is None:
+        return response
+    route = (request.url_rule.rule if request.url_rule is not None else "unmatched", request.method)
+    # streamed bodies, such as bulk exports, are not counted
+    size = 0 if response.is_streamed else (response.content_length or 0)
+    registry.record(route, response.status_code, stats, size)
+    return response
+
+def beforeCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    stats = current()
+    if stats is not None:
+        conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+def afterCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    finishStatement(conn, statement)
+
+# a failed statement gets no after_cursor_execute, so its start is popped here; otherwise it
+# would stay on the connection and be taken for the start of the next statement
+def handleError(context):
+    if context.connection is not None and context.statement is not None:
+        finishStatement(context.connection, context.statement)
+
+def finishStatement(conn, statement):
+    stats = current()
+    if stats is None or not conn.info.get("metrics_start"):
+        return
+    stats.dbTime += time.perf_counter() - conn.info["metrics_start"].pop()
+    stats.queries += 1
+    stats.statements[statement] += 1
+
+# encoding.dumps, timed as the JSON encoding of the current request
+def dumps(obj):
+    start = time.perf_counter()
+    body = encoding.dumps(obj)
+    stats = current()
+    if stats is not None:
+        stats.encodeTime += time.perf_counter() - start
+    return body
+
+def render():
+    return registry.render()
+
+# call before the other init_app()s, so afterRequest runs last and sees the compressed body
+def init_app(app):
+    if not app.config.get("METRICS", True):
+        return
+    app.before_request(beforeRequest)
+    app.after_request(afterRequest)
+    if not event.contains(Engine, "before_cursor_execute", beforeCursorExecute):
+        event.listen(Engine, "before_cursor_execute", beforeCursorExecute)
+        event.listen(Engine, "after_cursor_execute", afterCursorExecute)
+        event.listen(Engine, "handle_error", handleError)
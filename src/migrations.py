@@ -0,0 +1,344 @@
+from db import db
+import logging
+from sqlalchemy import func, inspect
+from sqlalchemy.sql import column, table
+
+# Versioned schema migrations. app.py runs upgrade() at startup; it applies, in order, every
+# migration newer than the version recorded in SchemaVersion. Each migration is frozen SQL for
+# the schema of its own version: it never reads the models in db.py or calls dao, search or
+# ingredients, so later changes to those cannot change what an old migration does. Each one also
+# checks the schema before changing it, so databases that an older release built with
+# create_all() upgrade too. Add new migrations to the end of MIGRATIONS only.
+#
+# Derived data that the application code computes, such as the ingredient index, is filled in by
+# that code after upgrade() instead; see app.py.
+
+logger = logging.getLogger(__name__)
+
+schemaVersion = table("SchemaVersion", column("version"))
+
+# the column types that SQLite and PostgreSQL spell differently; migration SQL writes them as
+# {serial} and {datetime}
+TYPES = {
+    "sqlite": {"serial": "INTEGER", "datetime": "DATETIME"},
+    "postgresql": {"serial": "SERIAL", "datetime": "TIMESTAMP WITHOUT TIME ZONE"}
+}
+
+
+def execute(*statements):
+    types = TYPES.get(db.engine.dialect.name, TYPES["postgresql"])
+    for statement in statements:
+        db.session.execute(statement.format(**types))
+
+def columnNames(tableName):
+    return [c["name"] for c in inspect(db.session.connection()).get_columns(tableName)]
+
+# as NOT NULL DEFAULT default, or as a nullable column when default is None
+def addColumn(tableName, columnName, columnType, default):
+    if columnName in columnNames(tableName):
+        return
+    constraint = "" if default is None else f" NOT NULL DEFAULT {default}"
+    execute(f'ALTER TABLE "{tableName}" ADD COLUMN "{columnName}" {columnType}{constraint}')
+
+
+########## MIGRATIONS #############
+
+# the tables of the original app, plus Timelines, which predates migrations
+def createTables():
+    execute(
+        '''CREATE TABLE IF NOT EXISTS "Users" (
+            id {serial} NOT NULL,
+            username VARCHAR NOT NULL,
+            password VARCHAR NOT NULL,
+            bio VARCHAR,
+            PRIMARY KEY (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Posts" (
+            id {serial} NOT NULL,
+            title VARCHAR NOT NULL,
+            "dateTime" {datetime} NOT NULL,
+            ingredients VARCHAR NOT NULL,
+            recipe VARCHAR,
+            "recipeTime" INTEGER NOT NULL,
+            "difficultyRating" INTEGER NOT NULL,
+            "overallRating" INTEGER NOT NULL,
+            "priceRating" INTEGER NOT NULL,
+            "userID" INTEGER,
+            vegan BOOLEAN NOT NULL,
+            vegetarian BOOLEAN NOT NULL,
+            kosher BOOLEAN NOT NULL,
+            "glutenFree" BOOLEAN NOT NULL,
+            mexican BOOLEAN NOT NULL,
+            asian BOOLEAN NOT NULL,
+            italian BOOLEAN NOT NULL,
+            french BOOLEAN NOT NULL,
+            dessert BOOLEAN NOT NULL,
+            breakfast BOOLEAN NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY("userID") REFERENCES "Users" (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Followers" (
+            "followerID" INTEGER,
+            "followedID" INTEGER,
+            FOREIGN KEY("followerID") REFERENCES "Users" (id),
+            FOREIGN KEY("followedID") REFERENCES "Users" (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Ratings" (
+            post_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            "overallRating" INTEGER,
+            "difficultyRating" INTEGER,
+            "priceRating" INTEGER,
+            PRIMARY KEY (post_id, user_id),
+            FOREIGN KEY(post_id) REFERENCES "Posts" (id),
+            FOREIGN KEY(user_id) REFERENCES "Users" (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Comments" (
+            id {serial} NOT NULL,
+            comment INTEGER NOT NULL,
+            "userID" INTEGER,
+            "postID" INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY("userID") REFERENCES "Users" (id),
+            FOREIGN KEY("postID") REFERENCES "Posts" (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Tags" (
+            id {serial} NOT NULL,
+            tag INTEGER NOT NULL,
+            "postID" INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY("postID") REFERENCES "Posts" (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS assets (
+            id {serial} NOT NULL,
+            img_type VARCHAR NOT NULL,
+            post_id INTEGER,
+            profile_id INTEGER,
+            base_url VARCHAR,
+            salt VARCHAR NOT NULL,
+            extension VARCHAR NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(post_id) REFERENCES "Posts" (id),
+            FOREIGN KEY(profile_id) REFERENCES "Users" (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "Timelines" (
+            "userID" INTEGER NOT NULL,
+            "postID" INTEGER NOT NULL,
+            "authorID" INTEGER NOT NULL,
+            "dateTime" {datetime} NOT NULL,
+            PRIMARY KEY ("userID", "postID"),
+            FOREIGN KEY("userID") REFERENCES "Users" (id),
+            FOREIGN KEY("postID") REFERENCES "Posts" (id),
+            FOREIGN KEY("authorID") REFERENCES "Users" (id)
+        )''')
+    db.session.commit()
+
+# Posts.popularity, rating_sum and rating_count, filled from existing ratings, and a fractional
+# Posts.overallRating; SQLite stores fractions in any numeric column
+def ratingCounters():
+    addColumn("Posts", "popularity", "FLOAT", 0)
+    addColumn("Posts", "rating_sum", "INTEGER", 0)
+    addColumn("Posts", "rating_count", "INTEGER", 0)
+    if db.engine.dialect.name == "postgresql":
+        execute('ALTER TABLE "Posts" ALTER COLUMN "overallRating" TYPE FLOAT')
+    execute(
+        '''UPDATE "Posts" SET
+            rating_sum = (SELECT coalesce(sum("Ratings"."overallRating"), 0) FROM "Ratings" WHERE "Ratings".post_id = "Posts".id),
+            rating_count = (SELECT count("Ratings"."overallRating") FROM "Ratings" WHERE "Ratings".post_id = "Posts".id)''',
+        '''UPDATE "Posts" SET "overallRating" = CASE WHEN rating_count > 0 THEN rating_sum * 1.0 / rating_count ELSE 0 END''',
+        '''UPDATE "Posts" SET popularity = CASE WHEN "overallRating" < 2 THEN rating_count / 2.0
+            WHEN "overallRating" > 4 THEN rating_count * 1.5 ELSE rating_count END''')
+    db.session.commit()
+
+# the Boolean tag columns of the original Posts; bit i of tagMask is column i
+TAG_COLUMNS = ["vegan", "vegetarian", "kosher", "glutenFree", "mexican",
+    "asian", "italian", "french", "dessert", "breakfast"]
+
+# replaces the Boolean tag columns with Posts.tagMask
+def tagMask():
+    tagColumns = [tag for tag in TAG_COLUMNS if tag in columnNames("Posts")]
+    if not tagColumns:
+        addColumn("Posts", "tagMask", "INTEGER", 0)
+        db.session.commit()
+        return
+
+    mask = " + ".join(f'(CASE WHEN "{tag}" THEN {1 << TAG_COLUMNS.index(tag)} ELSE 0 END)' for tag in tagColumns)
+    if db.engine.dialect.name != "sqlite":
+        addColumn("Posts", "tagMask", "INTEGER", 0)
+        execute(f'UPDATE "Posts" SET "tagMask" = {mask}')
+        for tag in tagColumns:
+            execute(f'ALTER TABLE "Posts" DROP COLUMN "{tag}"')
+        db.session.commit()
+        return
+
+    # SQLite cannot drop a column that a CHECK constraint uses, as the Boolean columns do, so
+    # Posts is copied into a new table without them
+    copied = '''id, title, "dateTime", ingredients, recipe, "recipeTime", "difficultyRating", "overallRating",
+        "priceRating", "userID", popularity, rating_sum, rating_count'''
+    execute(
+        '''CREATE TABLE "Posts_new" (
+            id INTEGER NOT NULL,
+            title VARCHAR NOT NULL,
+            "dateTime" DATETIME NOT NULL,
+            ingredients VARCHAR NOT NULL,
+            recipe VARCHAR,
+            "recipeTime" INTEGER NOT NULL,
+            "difficultyRating" INTEGER NOT NULL,
+            "overallRating" FLOAT NOT NULL,
+            "priceRating" INTEGER NOT NULL,
+            "userID" INTEGER,
+            popularity FLOAT NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            "tagMask" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id),
+            FOREIGN KEY("userID") REFERENCES "Users" (id)
+        )''',
+        f'INSERT INTO "Posts_new" ({copied}, "tagMask") SELECT {copied}, {mask} FROM "Posts"',
+        'DROP TABLE "Posts"',
+        'ALTER TABLE "Posts_new" RENAME TO "Posts"')
+    db.session.commit()
+
+# secondary indexes for every lookup, filter and ordering in dao, and a unique
+# (followerID, followedID) so a follow can only be recorded once
+def indexes():
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        execute('DELETE FROM "Followers" WHERE rowid NOT IN '
+            '(SELECT MIN(rowid) FROM "Followers" GROUP BY "followerID", "followedID")')
+    elif dialect == "postgresql":
+        execute('DELETE FROM "Followers" a USING "Followers" b WHERE a.ctid > b.ctid '
+            'AND a."followerID" = b."followerID" AND a."followedID" = b."followedID"')
+    execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_Followers_followerID_followedID" ON "Followers" ("followerID", "followedID")',
+        'CREATE INDEX IF NOT EXISTS "ix_Followers_followedID" ON "Followers" ("followedID", "followerID")',
+        'CREATE INDEX IF NOT EXISTS "ix_Timelines_userID_dateTime" ON "Timelines" ("userID", "dateTime", "postID")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_Users_username" ON "Users" (username)',
+        'CREATE INDEX IF NOT EXISTS "ix_Posts_popularity" ON "Posts" (popularity, id)',
+        'CREATE INDEX IF NOT EXISTS "ix_Posts_dateTime" ON "Posts" ("dateTime", id)',
+        'CREATE INDEX IF NOT EXISTS "ix_Posts_userID_dateTime" ON "Posts" ("userID", "dateTime", id)',
+        'CREATE INDEX IF NOT EXISTS "ix_Posts_priceRating_difficultyRating" ON "Posts" ("priceRating", "difficultyRating")',
+        'CREATE INDEX IF NOT EXISTS "ix_Posts_tagMask" ON "Posts" ("tagMask")',
+        'CREATE INDEX IF NOT EXISTS "ix_Ratings_user_id" ON "Ratings" (user_id)',
+        'CREATE INDEX IF NOT EXISTS "ix_Comments_postID" ON "Comments" ("postID")',
+        'CREATE INDEX IF NOT EXISTS ix_assets_post_id ON assets (post_id)',
+        'CREATE INDEX IF NOT EXISTS ix_assets_profile_id ON assets (profile_id)')
+    db.session.commit()
+
+# assets.status for the background upload pipeline; existing images are already uploaded
+def assetStatus():
+    addColumn("assets", "status", "VARCHAR", "'ready'")
+    db.session.commit()
+
+# assets.salt is the content hash of new images and is looked up to find duplicates
+def assetSaltIndex():
+    execute('CREATE INDEX IF NOT EXISTS ix_assets_salt ON assets (salt)')
+    db.session.commit()
+
+# resized copies of stored images, see variants.py
+def assetVariants():
+    execute(
+        '''CREATE TABLE IF NOT EXISTS asset_variants (
+            salt VARCHAR NOT NULL,
+            name VARCHAR NOT NULL,
+            extension VARCHAR NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            PRIMARY KEY (salt, name)
+        )''')
+    db.session.commit()
+
+# Posts.version and Users.version for ETags
+def versions():
+    addColumn("Posts", "version", "INTEGER", 1)
+    addColumn("Users", "version", "INTEGER", 1)
+    db.session.commit()
+
+# the FTS5 index behind /posts/search/ on SQLite, filled with every existing post
+def postSearch():
+    if db.engine.dialect.name != "sqlite":
+        return
+    execute(
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS "PostSearch" USING fts5(title, ingredients, recipe, tokenize='porter unicode61')''',
+        '''INSERT INTO "PostSearch"("PostSearch", rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')''',
+        '''INSERT INTO "PostSearch"(rowid, title, ingredients, recipe)
+            SELECT id, title, ingredients, coalesce(recipe, '') FROM "Posts" WHERE id NOT IN (SELECT rowid FROM "PostSearch")''')
+    db.session.commit()
+
+# the ingredient index behind /posts/cookable/. Posts.ingredientCount stays NULL until a post is
+# indexed, which ingredients.indexAll() does for existing posts after the upgrade.
+def ingredientIndex():
+    execute(
+        '''CREATE TABLE IF NOT EXISTS "IngredientPostings" (
+            ingredient VARCHAR NOT NULL,
+            "postID" INTEGER NOT NULL,
+            PRIMARY KEY (ingredient, "postID"),
+            FOREIGN KEY("postID") REFERENCES "Posts" (id)
+        )''',
+        'CREATE INDEX IF NOT EXISTS "ix_IngredientPostings_postID" ON "IngredientPostings" ("postID")')
+    addColumn("Posts", "ingredientCount", "INTEGER", None)
+    db.session.commit()
+
+# a B-tree index on Posts.tagMask cannot serve the bitwise tag filter, so it only slowed writes
+def dropTagMaskIndex():
+    execute('DROP INDEX IF EXISTS "ix_Posts_tagMask"')
+    db.session.commit()
+
+# the weighted tsvector index behind /posts/search/ on PostgreSQL; the expression must match
+# search.PG_DOCUMENT for queries to use it
+def postSearchPostgres():
+    if db.engine.dialect.name != "postgresql":
+        return
+    execute('''CREATE INDEX IF NOT EXISTS "ix_Posts_search" ON "Posts" USING gin ((
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(ingredients, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(recipe, '')), 'C')))''')
+    db.session.commit()
+
+# assets.created, so uploads.failAbandoned can tell uploads lost in a restart from running ones
+def assetCreated():
+    addColumn("assets", "created", "{datetime}", None)
+    db.session.commit()
+
+# a partial index of the posts the ingredient index has not seen, so the lookups of
+# ingredients.indexAll and bulk imports do not scan every post; it holds no rows once they are
+# indexed
+def unindexedPostsIndex():
+    execute('CREATE INDEX IF NOT EXISTS "ix_Posts_unindexed" ON "Posts" (id) WHERE "ingredientCount" IS NULL')
+    db.session.commit()
+
+MIGRATIONS = [
+    createTables,
+    ratingCounters,
+    tagMask,
+    indexes,
+    assetStatus,
+    assetSaltIndex,
+    assetVariants,
+    versions,
+    postSearch,
+    ingredientIndex,
+    dropTagMaskIndex,
+    postSearchPostgres,
+    assetCreated,
+    unindexedPostsIndex
+]
+
+
+def currentVersion():
+    execute('CREATE TABLE IF NOT EXISTS "SchemaVersion" (version INTEGER NOT NULL)')
+    db.session.commit()
+    return db.session.query(func.max(schemaVersion.c.version)).scalar() or 0
+
+# brings the database up to the newest migration; must run inside an app context
+def upgrade():
+    version = currentVersion()
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        logger.info(f"Applying migration {number}: {migration.__name__}")
+        migration()
+        db.session.execute(schemaVersion.insert().values(version=number))
+        db.session.commit()
@@ -0,0 +1,105 @@
+from sqlalchemy import and_, or_, DateTime, Integer, Numeric, String
+from sqlalchemy.sql import column
+import base64
+import datetime
+import json
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+OFFSET = column("offset", Integer)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+class InvalidLimit(ValueError):
+    pass
+
+
+# a cursor is the sort key of the last row of a page, packed so clients treat it as opaque
+def encodeCursor(values):
+    packed = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(packed).encode()).decode()
+
+# the JSON types a cursor value may have for each column type; bool is a subclass of int, so
+# true and false are refused separately
+CURSOR_TYPES = [(Integer, (int,)), (Numeric, (int, float)), (String, (str,)), (DateTime, (str,))]
+
+def decodeValue(column, value):
+    for columnType, valueTypes in CURSOR_TYPES:
+        if isinstance(column.type, columnType):
+            if isinstance(value, bool) or not isinstance(value, valueTypes):
+                raise TypeError(f"{value!r} is not a valid {column.key}")
+            if columnType is DateTime:
+                return datetime.datetime.fromisoformat(value)
+            return value
+    raise TypeError(f"{column.key} cannot be part of a cursor")
+
+def decodeCursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [decodeValue(c, v) for c, v in zip(columns, values)]
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor {cursor}") from e
+
+# rows that sort strictly after the given key, e.g. for (a, b):
+# a > x OR (a = x AND b > y)
+def keysetFilter(columns, values, descending=False):
+    clauses = []
+    for i, (sortColumn, value) in enumerate(zip(columns, values)):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        past = sortColumn < value if descending else sortColumn > value
+        clauses.append(and_(*(equal + [past])))
+    return or_(*clauses)
+
+# the ?limit= of a request, None when it is absent; anything but an integer from 1 to
+# MAX_PAGE_SIZE is rejected rather than falling back to the unpaginated list
+def parseLimit(text):
+    if text is None:
+        return None
+    try:
+        limit = int(text)
+    except ValueError:
+        raise InvalidLimit(f"limit must be an integer, not {text}") from None
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise InvalidLimit(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+def pageSize(limit):
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+# returns one page of the query ordered by columns, plus the cursor of the next page
+# (None when this is the last page). Only limit + 1 rows are ever fetched.
+# keys names the row attributes holding each column's value when they differ from the column keys.
+def paginate(query, columns, limit=None, after=None, descending=False, keys=None):
+    limit = pageSize(limit)
+    if after is not None:
+        query = query.filter(keysetFilter(columns, decodeCursor(after, columns), descending))
+    query = query.order_by(*[c.desc() if descending else c.asc() for c in columns])
+
+    rows = query.limit(limit + 1).all()
+    nextCursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        keys = keys or [c.key for c in columns]
+        nextCursor = encodeCursor([getattr(rows[-1], k) for k in keys])
+    return rows, nextCursor
+
+# for orderings with no key to resume from, such as search relevance; the cursor holds the
+# offset of the next page instead
+def paginateOffset(query, limit=None, after=None):
+    limit = pageSize(limit)
+    offset = 0 if after is None else decodeCursor(after, [OFFSET])[0]
+    if not isinstance(offset, int) or offset < 0:
+        raise InvalidCursor(f"Invalid cursor {after}")
+    rows = query.offset(offset).limit(limit + 1).all()
+    nextCursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        nextCursor = encodeCursor([offset + limit])
+    return rows, nextCursor
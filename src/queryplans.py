@@ -0,0 +1,69 @@
+from db import db, User, Post, Rating, Comment, Asset, followers, timelines, ingredientPostings
+import datetime
+import re
+from sqlalchemy import and_, exists
+
+# EXPLAIN QUERY PLAN checks for the queries dao runs on every request. A plan step that scans a
+# whole table instead of searching or walking an index means an index is missing. SQLite only.
+
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?(\S+)$")
+
+
+def hotQueries():
+    now = datetime.datetime.now()
+    return {
+        "user by username": User.query.filter_by(username="username"),
+        "is following": db.session.query(exists().where(and_(followers.c.followerID == 1, followers.c.followedID == 2))),
+        "followed usernames": db.session.query(followers.c.followerID, User.username)
+            .select_from(followers).join(User, User.id == followers.c.followedID)
+            .filter(followers.c.followerID.in_([1, 2])),
+        "follower usernames": db.session.query(followers.c.followedID, User.username)
+            .select_from(followers).join(User, User.id == followers.c.followerID)
+            .filter(followers.c.followedID.in_([1, 2])),
+        "posts page": Post.query.filter(Post.dateTime < now)
+            .order_by(Post.dateTime.desc(), Post.id.desc()).limit(21),
+        "posts by user": Post.query.filter_by(userID=1).order_by(Post.dateTime.desc(), Post.id.desc()).limit(21),
+        "posts by price and difficulty": Post.query.filter_by(priceRating=1, difficultyRating=2),
+        "popular posts": Post.query.order_by(Post.popularity.desc(), Post.id.desc()).limit(21),
+        # the bitmask filter cannot seek, so these walk the ordering index and stop after a page
+        "posts page by tags": Post.query.filter(Post.tagMask.op("&")(3) == 3)
+            .order_by(Post.dateTime.desc(), Post.id.desc()).limit(21),
+        "popular posts by tags": Post.query.filter(Post.tagMask.op("&")(3) == 3)
+            .order_by(Post.popularity.desc(), Post.id.desc()).limit(21),
+        "following feed": Post.query.join(followers, followers.c.followedID == Post.userID)
+            .filter(followers.c.followerID == 1),
+        "timeline feed": Post.query.join(timelines, timelines.c.postID == Post.id)
+            .filter(timelines.c.userID == 1)
+            .order_by(timelines.c.dateTime.desc(), timelines.c.postID.desc()).limit(21),
+        "post comments": Comment.query.filter(Comment.postID.in_([1, 2])),
+        "post photos": Asset.query.filter(Asset.post_id.in_([1, 2])),
+        "stored image": Asset.query.filter_by(salt="salt", status="ready"),
+        "ingredient postings": db.session.query(ingredientPostings.c.postID)
+            .filter(ingredientPostings.c.ingredient.in_(["egg", "rice"])),
+        "post ingredients": db.session.query(ingredientPostings.c.ingredient)
+            .filter(ingredientPostings.c.postID.in_([1, 2])),
+        "posts awaiting ingredient index": db.session.query(Post.id, Post.ingredients)
+            .filter(Post.ingredientCount.is_(None)).order_by(Post.id).limit(500),
+        "user ratings": Rating.query.filter_by(user_id=1),
+        "rating": Rating.query.filter_by(post_id=1, user_id=1)
+    }
+
+def explain(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # only the plan is needed, so every parameter can be NULL
+        cursor.execute(f"EXPLAIN QUERY PLAN {compiled}", [None] * len(compiled.positiontup))
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+# returns {query name: [plan steps that scan a whole table]} for every hot query that has any
+def fullScans():
+    failures = {}
+    for name, query in hotQueries().items():
+        scans = [step for step in explain(query) if FULL_SCAN.match(step)]
+        if scans:
+            failures[name] = scans
+    return failures
@@ -0,0 +1,64 @@
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+import random
+from sqlalchemy import orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+# Read/write splitting. app.config["SQLALCHEMY_REPLICAS"] lists the URLs of read replicas of the
+# primary database, which database.init_app registers as the binds "replica0", "replica1" and so
+# on. Statements run inside a db.readonly function go to a replica, picked once per session so a
+# request reads from a single copy; everything else goes to the primary. Once a session writes,
+# by flushing or by executing an INSERT, UPDATE or DELETE, all its reads stay on the primary until
+# the session ends with the request, so a request always reads its own writes. Without replicas
+# everything runs on the primary as before.
+
+REPLICA_BIND = "replica{}"
+READ_STATEMENTS = ("SELECT", "WITH", "PRAGMA", "EXPLAIN") # raw SQL that does not write
+
+
+def replicaBinds(app):
+    return [REPLICA_BIND.format(i) for i in range(len(app.config.get("SQLALCHEMY_REPLICAS") or ()))]
+
+def writes(clause):
+    if isinstance(clause, UpdateBase): # insert, update and delete, including Query.update()
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith(READ_STATEMENTS)
+    return False
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or writes(clause):
+            self.info["wrote"] = True
+        elif self.info.get("readonly") and not self.info.get("wrote"):
+            binds = replicaBinds(self.app)
+            if binds:
+                if "replica" not in self.info:
+                    self.info["replica"] = random.choice(binds)
+                return self.db.get_engine(self.app, bind=self.info["replica"])
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    # Flask-SQLAlchemy gives file SQLite a NullPool, which opens a new connection for every
+    # checkout, so the pragmas of database.py would run again and the page cache would be lost
+    # each time. Such databases get a QueuePool sized like the server pools instead; a pooled
+    # connection is handed from thread to thread, one at a time. In-memory SQLite keeps its
+    # StaticPool, which takes no size.
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == "sqlite":
+            if info.database in (None, "", ":memory:"):
+                for option in ("pool_size", "max_overflow", "pool_timeout"):
+                    options.pop(option, None)
+            elif options.get("pool_size"):
+                options["poolclass"] = QueuePool
+                options.setdefault("connect_args", {})["check_same_thread"] = False
+        super().apply_driver_hacks(app, info, options)
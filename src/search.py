@@ -0,0 +1,75 @@
+from db import db, Post
+import re
+from sqlalchemy import func, literal_column
+from sqlalchemy.sql import column, table
+
+# Full-text recipe search. PostSearch is an SQLite FTS5 table over the title, ingredients and
+# recipe of every post, with the post id as its rowid. dao.post and dao.deletePost keep it in
+# sync inside their own transactions. Results are ranked by bm25, weighting title matches over
+# ingredient matches over recipe matches.
+#
+# On PostgreSQL the same search runs on a weighted tsvector of those columns instead, backed by
+# a GIN expression index that PostgreSQL maintains itself, so there is nothing to keep in sync.
+# The FTS5 table, its bm25 weights and the GIN index are created by migrations.py.
+
+TABLE = "PostSearch"
+
+postSearch = table(TABLE, column("rowid"), column("rank"))
+
+# the tsvector the GIN index of migrations.postSearchPostgres is built on; queries must use the
+# same expression to use the index
+PG_DOCUMENT = ("setweight(to_tsvector('english', coalesce({p}title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({p}ingredients, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce({p}recipe, '')), 'C')")
+PG_WEIGHTS = "'{0, 0.1, 0.5, 1.0}'" # D, C, B, A in ts_rank order; the ratios of the bm25 weights
+
+
+# whether the FTS5 table is used and has to be kept in sync
+def enabled():
+    return db.engine.dialect.name == "sqlite"
+
+def postgres():
+    return db.engine.dialect.name == "postgresql"
+
+def index(post):
+    if not enabled():
+        return
+    remove(post.id)
+    db.session.execute(f'INSERT INTO "{TABLE}"(rowid, title, ingredients, recipe) '
+        'VALUES (:id, :title, :ingredients, :recipe)',
+        {"id": post.id, "title": post.title, "ingredients": post.ingredients, "recipe": post.recipe or ""})
+
+# indexes posts that are not in the index yet, given as (id, title, ingredients, recipe) rows
+def indexNew(posts):
+    if not enabled() or not posts:
+        return
+    db.session.execute(f'INSERT INTO "{TABLE}"(rowid, title, ingredients, recipe) '
+        'VALUES (:id, :title, :ingredients, :recipe)',
+        [{"id": i, "title": t, "ingredients": ing, "recipe": r or ""} for i, t, ing, r in posts])
+
+def remove(post_id):
+    if not enabled():
+        return
+    db.session.execute(f'DELETE FROM "{TABLE}" WHERE rowid = :id', {"id": post_id})
+
+# turns what a user typed into an FTS5 query, or a tsquery on PostgreSQL, matching every word,
+# the last one as a prefix; None when there is nothing to search for. Only the words are kept,
+# which keeps the query syntax out of it.
+def matchQuery(text):
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return None
+    if postgres():
+        return " & ".join(words) + ":*"
+    return " ".join(f'"{w}"' for w in words) + "*"
+
+# narrows a post query to the posts matching match, best first
+def rankedQuery(query, match):
+    if postgres():
+        document = literal_column(PG_DOCUMENT.format(p=f'"{Post.__tablename__}".'))
+        tsquery = func.to_tsquery(literal_column("'english'"), match)
+        rank = func.ts_rank(literal_column(PG_WEIGHTS), document, tsquery)
+        return query.filter(document.op("@@")(tsquery)).order_by(rank.desc(), Post.id)
+    return query.join(postSearch, postSearch.c.rowid == Post.id) \
+        .filter(literal_column(f'"{TABLE}"').op("MATCH")(match)) \
+        .order_by(postSearch.c.rank, Post.id)
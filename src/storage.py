@@ -0,0 +1,107 @@
+import boto3
+from flask import current_app
+from io import BytesIO
+import os
+import shutil
+import threading
+
+# Image storage backends. Each one stores objects by key from bytes or a binary file object,
+# without temp files, and builds the public url of a key. app.config["STORAGE_BACKEND"] picks
+# one: "s3" (default), "local" for development and CI, or "memory" for tests.
+
+S3_BUCKET = "recipeappimages"
+S3_BASE_URL = f"https://{S3_BUCKET}.s3-us-east-2.amazonaws.com"
+
+
+def readable(body):
+    return BytesIO(body) if isinstance(body, bytes) else body
+
+class Storage:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def put(self, key, body, content_type=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket=S3_BUCKET, base_url=S3_BASE_URL):
+        super().__init__(base_url)
+        self.bucket = bucket
+        self._client = None
+        self._lock = threading.Lock()
+
+    # one client for the whole process; boto3 clients are thread safe and keep their connection pool
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.session.Session().client("s3")
+        return self._client
+
+    # a single request that streams the body and makes the object public
+    def put(self, key, body, content_type=None):
+        extra = {"ACL": "public-read"}
+        if content_type is not None:
+            extra["ContentType"] = content_type
+        self.client.upload_fileobj(readable(body), self.bucket, key, ExtraArgs=extra)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class LocalStorage(Storage):
+    def __init__(self, root, base_url="/images"):
+        super().__init__(base_url)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, os.path.basename(key))
+
+    def put(self, key, body, content_type=None):
+        with open(self.path(key), "wb") as f:
+            shutil.copyfileobj(readable(body), f)
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+
+class MemoryStorage(Storage):
+    def __init__(self, base_url="memory:/"):
+        super().__init__(base_url)
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, body, content_type=None):
+        data = readable(body).read()
+        with self._lock:
+            self.objects[key] = data
+
+    def delete(self, key):
+        with self._lock:
+            self.objects.pop(key, None)
+
+
+def init_app(app):
+    backend = app.config.get("STORAGE_BACKEND", "s3")
+    if backend == "local":
+        storage = LocalStorage(app.config.get("LOCAL_STORAGE_DIR", os.path.join(app.root_path, "images")))
+    elif backend == "memory":
+        storage = MemoryStorage()
+    elif backend == "s3":
+        storage = S3Storage(app.config.get("S3_BUCKET", S3_BUCKET), app.config.get("S3_BASE_URL", S3_BASE_URL))
+    else:
+        raise ValueError(f"Unknown storage backend {backend}")
+    app.extensions["storage"] = storage
+
+def current():
+    return current_app.extensions["storage"]
@@ -0,0 +1,63 @@
+import hashlib
+from PIL import Image, ImageFile
+from tempfile import SpooledTemporaryFile
+
+# Binary image uploads. read() copies an upload body in chunks into a spooled temporary file,
+# hashing it on the way, and validates the format and dimensions from the image header alone:
+# the pixels are never decoded and the body is never held in memory as a whole.
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024 # bodies larger than this are spooled to disk
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+FORMATS = {"PNG": "png", "GIF": "gif", "JPEG": "jpg"} # Pillow format: extension
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+# an upload that has been read; file is positioned at its start
+class StreamedImage:
+    def __init__(self, file, salt, extension, content_type, width, height, size):
+        self.file = file
+        self.salt = salt
+        self.extension = extension
+        self.content_type = content_type
+        self.width = width
+        self.height = height
+        self.size = size
+
+
+# reads a binary stream; raises ImageTooLarge past the limits and ValueError for anything that
+# is not a supported image
+def read(stream, max_bytes=MAX_IMAGE_BYTES):
+    file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        digest = hashlib.sha256()
+        parser = ImageFile.Parser()
+        size = 0
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise ImageTooLarge(f"Images can be at most {max_bytes} bytes!")
+            digest.update(chunk)
+            file.write(chunk)
+            # the parser only needs to see the header; feeding it more would decode pixels
+            if parser.image is None:
+                parser.feed(chunk)
+
+        img = parser.image
+        if img is None or img.format not in FORMATS:
+            raise ValueError("Unsupported or invalid image!")
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            raise ImageTooLarge(f"Images can have at most {MAX_IMAGE_PIXELS} pixels!")
+        file.seek(0)
+        return StreamedImage(file, digest.hexdigest(), FORMATS[img.format], Image.MIME[img.format],
+            img.width, img.height, size)
+    except (ValueError, OSError, SyntaxError):
+        file.close()
+        raise
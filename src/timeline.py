@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+from db import db, Post, commitChanges, followers, timelines
+from flask import current_app
+import logging
+from sqlalchemy import bindparam, func, literal, select
+
+# Fan-out-on-write following feeds. When app.config["TIMELINE_FANOUT"] is set, every new post is
+# pushed into the Timelines rows of its author's followers, so reading a feed is a range scan over
+# ix_Timelines_userID_dateTime instead of a join over everything the reader follows. A feed's ETag
+# comes from the versions of the users it follows (dao.feedVersion), so each push bumps the
+# author's version again once it is committed; a feed read before the push cannot keep its ETag.
+
+TIMELINE_SIZE = 500 # newest entries kept per user
+INLINE_FANOUT = 100 # posts by users with more followers than this are fanned out in the background
+
+logger = logging.getLogger(__name__)
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+def enabled():
+    return current_app.config.get("TIMELINE_FANOUT", False)
+
+def feedQuery(query, user_id):
+    return query.join(timelines, timelines.c.postID == Post.id).filter(timelines.c.userID == user_id)
+
+# drops everything past the newest TIMELINE_SIZE entries of each user's timeline
+def trim(user_ids):
+    if not user_ids:
+        return
+    newest = select([timelines.c.postID]) \
+        .where(timelines.c.userID == bindparam("user")) \
+        .order_by(timelines.c.dateTime.desc(), timelines.c.postID.desc()) \
+        .limit(TIMELINE_SIZE)
+    delete = timelines.delete() \
+        .where(timelines.c.userID == bindparam("user")) \
+        .where(~timelines.c.postID.in_(newest))
+    db.session.execute(delete, [{"user": u} for u in user_ids])
+
+def push(post_id, author_id, dateTime):
+    readers = select([
+        followers.c.followerID,
+        literal(post_id, db.Integer),
+        literal(author_id, db.Integer),
+        literal(dateTime, db.DateTime)
+    ]).where(followers.c.followedID == author_id).distinct()
+    db.session.execute(timelines.insert().from_select(["userID", "postID", "authorID", "dateTime"], readers))
+    user_ids = [u for u, in db.session.query(followers.c.followerID).filter(followers.c.followedID == author_id).distinct()]
+    trim(user_ids)
+
+def pushInBackground(app, post_id, author_id, dateTime):
+    with app.app_context():
+        try:
+            push(post_id, author_id, dateTime)
+            commitChanges(user_ids=[author_id])
+        except Exception:
+            db.session.rollback()
+            logger.exception(f"Unable to fan out post {post_id}")
+
+# called after a new post is committed
+def fanOut(post):
+    count = db.session.query(func.count(followers.c.followerID)).filter(followers.c.followedID == post.userID).scalar()
+    if count > INLINE_FANOUT:
+        app = current_app._get_current_object()
+        executor.submit(pushInBackground, app, post.id, post.userID, post.dateTime)
+        return
+    push(post.id, post.userID, post.dateTime)
+    commitChanges(user_ids=[post.userID])
+
+def prune(follower_id, followed_id):
+    db.session.execute(timelines.delete()
+        .where(timelines.c.userID == follower_id)
+        .where(timelines.c.authorID == followed_id))
+
+def backfill(follower_id, followed_id):
+    prune(follower_id, followed_id)
+    newest = select([
+        literal(follower_id, db.Integer), Post.id, Post.userID, Post.dateTime
+    ]).where(Post.userID == followed_id).order_by(Post.dateTime.desc(), Post.id.desc()).limit(TIMELINE_SIZE)
+    db.session.execute(timelines.insert().from_select(["userID", "postID", "authorID", "dateTime"], newest))
+    trim([follower_id])
+
+def removePost(post_id):
+    db.session.execute(timelines.delete().where(timelines.c.postID == post_id))
+
+# rebuilds every timeline from the followers table, e.g. when turning TIMELINE_FANOUT on
+def rebuild():
+    db.session.execute(timelines.delete())
+    for follower_id, followed_id in db.session.query(followers.c.followerID, followers.c.followedID).distinct():
+        backfill(follower_id, followed_id)
+    db.session.commit()
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from db import db, Asset, AssetVariant, commitChanges, lockSalt
+from flask import current_app
+import logging
+from sqlalchemy import or_
+import storage
+import threading
+import time
+import variants
+
+# Background image uploads. dao.uploadImage commits the asset as "pending" and hands its decoded
+# bytes to submit(); a bounded pool of workers puts them in the storage backend, retrying with
+# backoff, and marks the asset "ready" or "failed". GET /image/<id>/ reports the status. Assets
+# with the same salt share the stored object, so the status of all of them is updated together.
+# Once an image is ready its variants are generated and stored the same way.
+#
+# The bytes of a queued upload only live in memory, so an upload that was queued or running when
+# its process stopped can never finish. app.py calls failAbandoned() at startup to mark those
+# failed; the client uploads the image again.
+
+MAX_WORKERS = 4
+MAX_PENDING = 64 # uploads queued or running at once; submit() refuses more
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1 # seconds before the first retry, doubled for each one after
+# seconds after which a pending upload is taken to be lost; well past the longest run() with
+# retries, so uploads still running in other processes are left alone
+PENDING_TIMEOUT = 15 * 60
+
+logger = logging.getLogger(__name__)
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+slots = threading.BoundedSemaphore(MAX_PENDING)
+
+
+# data is bytes or a binary file, which is rewound before every attempt
+def storeWithRetries(backend, asset_id, data, filename, content_type):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            if not isinstance(data, bytes):
+                data.seek(0)
+            backend.put(filename, data, content_type)
+            return True
+        except Exception:
+            logger.exception(f"Attempt {attempt + 1} to upload image {asset_id} failed")
+            if attempt + 1 < MAX_ATTEMPTS:
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+    return False
+
+def run(app, asset_id, salt, data, filename, content_type):
+    try:
+        with app.app_context():
+            backend = storage.current()
+            stored = storeWithRetries(backend, asset_id, data, filename, content_type)
+            status = "ready" if stored else "failed"
+            Asset.query.filter(Asset.salt == salt, Asset.status != "ready") \
+                .update({Asset.status: status}, synchronize_session=False)
+            lockSalt(salt)
+            # every asset was deleted while it was uploading
+            if stored and Asset.query.filter_by(salt=salt).count() == 0:
+                backend.delete(filename)
+                stored = False
+            commitChanges(*owners(salt))
+            if stored:
+                storeVariants(backend, asset_id, salt, data, filename, content_type)
+    except Exception:
+        logger.exception(f"Unable to finish uploading image {asset_id}")
+    finally:
+        if not isinstance(data, bytes):
+            data.close()
+        slots.release()
+
+def storeVariants(backend, asset_id, salt, data, filename, content_type):
+    if AssetVariant.query.filter_by(salt=salt).count() > 0:
+        return
+    extension = filename.rsplit(".", 1)[1]
+    # the worker processes need the whole image
+    if not isinstance(data, bytes):
+        data.seek(0)
+        data = data.read()
+    stored = []
+    for name, body, width, height, ext, ctype in variants.generate(data, extension, content_type):
+        variant = AssetVariant(salt=salt, name=name, extension=ext, width=width, height=height)
+        if storeWithRetries(backend, asset_id, body, variant.filename(), ctype):
+            db.session.merge(variant)
+            stored.append(variant.filename())
+    db.session.flush()
+    lockSalt(salt)
+    # every asset was deleted while the variants were made
+    if Asset.query.filter_by(salt=salt).count() == 0:
+        for key in stored:
+            backend.delete(key)
+        db.session.rollback()
+        return
+    commitChanges(*owners(salt))
+
+# the status and variants of every asset sharing the image are serialized in its owners
+def owners(salt):
+    post_ids, user_ids = [], []
+    for asset in Asset.query.filter_by(salt=salt):
+        posts, users = asset.owners()
+        post_ids += posts
+        user_ids += users
+    return post_ids, user_ids
+
+# queues the upload of a committed pending asset; False when the queue is full
+def submit(asset):
+    if not slots.acquire(blocking=False):
+        return False
+    app = current_app._get_current_object()
+    try:
+        executor.submit(run, app, asset.id, asset.salt, asset.data, asset.filename(), asset.content_type)
+    except Exception:
+        slots.release()
+        raise
+    return True
+
+# marks failed the pending assets older than PENDING_TIMEOUT, and those too old to record when
+# they were created; returns how many were marked
+def failAbandoned(now=None):
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(seconds=PENDING_TIMEOUT)
+    abandoned = Asset.query.filter(Asset.status == "pending",
+        or_(Asset.created.is_(None), Asset.created < cutoff)).all()
+    post_ids, user_ids = [], []
+    for asset in abandoned:
+        asset.status = "failed"
+        posts, users = asset.owners()
+        post_ids += posts
+        user_ids += users
+    commitChanges(post_ids, user_ids)
+    if abandoned:
+        logger.warning(f"Marked {len(abandoned)} abandoned uploads failed")
+    return len(abandoned)
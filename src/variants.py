@@ -0,0 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import multiprocessing
+from PIL import Image
+import threading
+
+# Derived image sizes. After uploads.py stores an image it calls generate(), which resizes the
+# image in a pool of worker processes, so resizing never holds the GIL of the web workers. Each
+# variant is stored next to the original as "<salt>_<name>.<extension>" and recorded as an
+# AssetVariant row with its dimensions.
+
+MAX_PROCESSES = 2
+
+# name: (width, format), where a format of None keeps the original one. Images narrower than a
+# width are not upscaled.
+VARIANTS = {
+    "thumb_150": (150, None),
+    "thumb_300": (300, None),
+    "feed": (800, None),
+    "thumb_150_webp": (150, "WEBP"),
+    "thumb_300_webp": (300, "WEBP"),
+    "feed_webp": (800, "WEBP"),
+}
+
+FORMATS = {"WEBP": ("webp", "image/webp")}
+
+pool = None
+poolLock = threading.Lock()
+
+
+def processPool():
+    global pool
+    with poolLock:
+        if pool is None:
+            # forking a process that runs web and upload threads can copy a lock another thread
+            # holds, e.g. in logging or the database driver, and deadlock the child; spawn starts
+            # each worker from a fresh interpreter instead
+            pool = ProcessPoolExecutor(max_workers=MAX_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return pool
+
+# runs in a worker process; returns [(name, bytes, width, height, extension, content type)]
+def resize(data, extension, content_type):
+    original = Image.open(BytesIO(data))
+    original.load()
+    Image.init()
+    results = []
+    for name, (width, fmt) in VARIANTS.items():
+        # Pillow built without a codec, e.g. libwebp, cannot write that format
+        if fmt is not None and fmt not in Image.SAVE:
+            continue
+        img = original.copy()
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        if fmt is None:
+            fmt, ext, ctype = original.format, extension, content_type
+        else:
+            ext, ctype = FORMATS[fmt]
+        if fmt == "WEBP" and img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        out = BytesIO()
+        img.save(out, format=fmt)
+        results.append((name, out.getvalue(), img.width, img.height, ext, ctype))
+    return results
+
+# blocks the calling thread, not the process, until every variant of the image is encoded
+def generate(data, extension, content_type):
+    return processPool().submit(resize, data, extension, content_type).result()
@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+
+# app.py configures itself from the environment when it is imported, so the tests point it at a
+# fresh SQLite file before importing it, unless DATABASE_URL names another empty database:
+#
+#   python -m pytest tests
+#   DATABASE_URL=postgresql://localhost/collegekitchen_test python -m pytest tests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["CACHE_BACKEND"] = "none"
+
+from app import app as application
+from db import db
+import pytest
+import search
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@pytest.fixture
+def app():
+    return application
+
+# requests push their own app context, and so get a new session each, as in production
+@pytest.fixture
+def client():
+    return application.test_client()
+
+# every test starts from an empty database at the newest schema version
+@pytest.fixture(autouse=True)
+def emptyDatabase():
+    yield
+    with application.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        if search.enabled():
+            db.session.execute(f'DELETE FROM "{search.TABLE}"')
+        db.session.commit()
+
+# the SQL statements run while the test holds it, on any engine
+@pytest.fixture
+def statements():
+    executed = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+    event.listen(Engine, "after_cursor_execute", record)
+    yield executed
+    event.remove(Engine, "after_cursor_execute", record)
+
+@pytest.fixture
+def make_user(client):
+    def make(username, bio=""):
+        response = client.post("/register/", json={"username": username, "password": "password", "bio": bio})
+        assert response.status_code == 200, response.get_data()
+        return response.get_json()["data"]["user_id"]
+    return make
+
+@pytest.fixture
+def make_post(client):
+    def make(user_id, **fields):
+        body = {"title": "Egg fried rice", "ingredients": "rice, egg, soy sauce", "recipe": "Fry it all.",
+            "recipeTime": 10, "difficultyRating": 1, "priceRating": 1}
+        body.update(fields)
+        response = client.post(f"/user/{user_id}/post/", json=body)
+        assert response.status_code == 200, response.get_data()
+        return response.get_json()["data"]["post_id"]
+    return make
+
+@pytest.fixture
+def follow(client):
+    def make(follower_id, followed_id):
+        response = client.post(f"/user/{follower_id}/follow/", json={"followed_user_id": followed_id})
+        assert response.status_code == 200, response.get_data()
+    return make
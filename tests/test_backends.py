@@ -0,0 +1,54 @@
+from db import db
+import os
+import pytest
+from sqlalchemy.pool import QueuePool
+
+# The suite runs on the database that DATABASE_URL names, SQLite by default; each backend's
+# checks are skipped on the other one. PostgreSQL needs DATABASE_URL pointing at an empty database.
+BACKENDS = ["sqlite", "postgresql"]
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": 1, # NORMAL
+    "busy_timeout": 5000,
+    "cache_size": -65536,
+    "mmap_size": 256 * 1024 * 1024
+}
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, app):
+    if request.param == "postgresql" and not os.environ["DATABASE_URL"].startswith(("postgresql", "postgres:")):
+        pytest.skip("set DATABASE_URL to a PostgreSQL database")
+    with app.app_context():
+        if db.engine.dialect.name != request.param:
+            pytest.skip(f"the tests run on {db.engine.dialect.name}")
+    return request.param
+
+def test_engine_settings(app, backend):
+    with app.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
+        assert db.engine.pool.size() == app.config["SQLALCHEMY_POOL_SIZE"]
+        if backend == "sqlite":
+            pragmas = {name: db.session.execute(f"PRAGMA {name}").scalar() for name in SQLITE_PRAGMAS}
+            assert pragmas == SQLITE_PRAGMAS
+
+def test_core_routes(client, backend, make_user, make_post, follow):
+    alice, bob = make_user("alice"), make_user("bob")
+    post_id = make_post(alice, title="Vegan fried rice")
+    assert client.post(f"/post/{post_id}/tag/", json={"tags": ["vegan"]}).status_code == 200
+    follow(bob, alice)
+
+    feed = client.get(f"/user/{bob}/following/posts/?limit=5").get_json()["data"]
+    assert [p["post_id"] for p in feed["items"]] == [post_id]
+    found = client.post("/posts/search/", json={"query": "fried"}).get_json()["data"]
+    assert [p["post_id"] for p in found["items"]] == [post_id]
+    cookable = client.post("/posts/cookable/", json={"ingredients": ["rice", "egg"]}).get_json()["data"]
+    assert [p["post_id"] for p in cookable["items"]] == [post_id]
+
+    rated = client.post(f"/post/{post_id}/overall/", json={"user_id": bob, "score": 5})
+    assert rated.status_code == 200, rated.get_data()
+    popular = client.post("/posts/popular/?limit=5", json={}).get_json()["data"]
+    assert [(p["post_id"], p["overallRating"]) for p in popular["items"]] == [(post_id, 5)]
+    filtered = client.post("/posts/filter/?limit=5", json={"tags": ["vegan"]}).get_json()["data"]
+    assert [p["post_id"] for p in filtered["items"]] == [post_id]
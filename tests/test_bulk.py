@@ -0,0 +1,24 @@
+import bulk
+from flask import request
+import json
+
+
+# ratings have a two-column key, so small batches exercise every branch of the keyset filter
+def test_export_resumes_every_batch(client, monkeypatch):
+    lines = [{"type": "user", "id": i, "username": f"user{i}", "password": "password"} for i in (1, 2, 3)]
+    lines += [{"type": "post", "id": i, "user_id": 1, "title": "Egg fried rice", "ingredients": "rice, egg",
+        "recipeTime": 10, "difficultyRating": 1, "priceRating": 1} for i in (1, 2)]
+    lines += [{"type": "rating", "post_id": p, "user_id": u, "overallRating": 4} for p in (1, 2) for u in (1, 2, 3)]
+    body = "".join(json.dumps(line) + "\n" for line in lines)
+    imported = client.post("/bulk/import/", data=body, content_type="application/x-ndjson").get_json()["data"]
+    assert (imported["users"], imported["posts"], imported["ratings"]) == (3, 2, 6)
+
+    monkeypatch.setattr(bulk, "BATCH_SIZE", 2)
+    exported = [json.loads(line) for line in client.get("/bulk/export/?types=rating").get_data().splitlines()]
+    assert [(r["post_id"], r["user_id"]) for r in exported] == [(p, u) for p in (1, 2) for u in (1, 2, 3)]
+
+def test_bulk_import_takes_larger_bodies(app):
+    with app.test_request_context("/bulk/import/", method="POST"):
+        assert request.max_content_length == app.config["BULK_IMPORT_MAX_CONTENT_LENGTH"]
+    with app.test_request_context("/register/", method="POST"):
+        assert request.max_content_length == app.config["MAX_CONTENT_LENGTH"]
@@ -0,0 +1,21 @@
+import cache
+import pytest
+
+
+@pytest.fixture
+def localCache(app, monkeypatch):
+    current = cache.Cache()
+    monkeypatch.setitem(app.extensions, "cache", current)
+    return current
+
+# an unpaginated list can be any size, so only pages of it are cached
+@pytest.mark.parametrize("route", ["/posts/filter/", "/posts/popular/"])
+def test_caches_pages_only(client, make_user, make_post, localCache, route):
+    make_post(make_user("alice"))
+    entries = localCache.stats()["entries"]
+    assert client.post(route, json={"price": 1}).status_code == 200
+    assert localCache.stats()["entries"] == entries
+    for _ in range(2):
+        assert client.post(f"{route}?limit=5", json={"price": 1}).status_code == 200
+    assert localCache.stats()["entries"] == entries + 1
+    assert localCache.stats()["hits"] == 1
@@ -0,0 +1,24 @@
+from db import db
+import metrics
+import pytest
+from sqlalchemy.exc import DBAPIError
+
+
+# a failed statement must not leave its start time behind for the next statement to pop
+def test_failed_statement_is_timed(app):
+    with app.test_request_context("/"), app.app_context():
+        metrics.beforeRequest()
+        with pytest.raises(DBAPIError):
+            db.session.execute('SELECT * FROM "NoSuchTable"')
+        db.session.rollback()
+        connection = db.session.connection()
+        assert not connection.info.get("metrics_start")
+        db.session.execute("SELECT 1")
+        assert not connection.info.get("metrics_start")
+        assert metrics.current().queries == 2
+
+def test_renders_json_encode_time(client, make_user):
+    make_user("alice")
+    body = client.get("/metrics").get_data(as_text=True)
+    assert 'json_encode_seconds_total{route="/register/",method="POST"}' in body
+    assert "serialize_seconds_total" not in body
@@ -0,0 +1,54 @@
+from db import db
+import database
+from flask import Flask
+import migrations
+import os
+import pytest
+import shutil
+from sqlalchemy import inspect
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "app.db")
+
+
+# {table: ({column: nullable}, {index names})} of the connected database, for the tables in db.py
+def schema(engine):
+    inspector = inspect(engine)
+    return {
+        table.name: (
+            {c["name"]: c["nullable"] for c in inspector.get_columns(table.name)},
+            {i["name"] for i in inspector.get_indexes(table.name)}
+        ) for table in db.metadata.sorted_tables
+    }
+
+def modelSchema():
+    return {
+        table.name: (
+            {c.name: c.nullable for c in table.columns},
+            {i.name for i in table.indexes}
+        ) for table in db.metadata.sorted_tables
+    }
+
+def test_migrated_schema_matches_models(app):
+    with app.app_context():
+        assert schema(db.engine) == modelSchema()
+
+# the database the app shipped with before migrations existed, with Boolean tag columns
+def test_upgrades_baseline_database(app, tmp_path):
+    if db.get_engine(app).dialect.name != "sqlite":
+        pytest.skip("the baseline database is SQLite")
+    path = tmp_path / "app.db"
+    shutil.copy(BASELINE, path)
+    baseline = Flask(migrations.__name__)
+    baseline.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    baseline.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(baseline)
+    database.init_app(baseline)
+
+    with baseline.app_context():
+        migrations.upgrade()
+        migrations.upgrade() # a second run has nothing left to do
+        assert migrations.currentVersion() == len(migrations.MIGRATIONS)
+        assert schema(db.engine) == modelSchema()
+        posts = db.session.execute('SELECT id, "tagMask", "overallRating", rating_count, version '
+            'FROM "Posts" ORDER BY id').fetchall()
+        assert [tuple(post) for post in posts] == [(1, 2, 0, 0, 1), (2, 0, 0, 0, 1)] # post 1 is vegetarian
@@ -0,0 +1,56 @@
+import base64
+import json
+import pytest
+
+
+def cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+# every page of route, following next_cursor
+def walk(client, route, method="GET"):
+    items, after = [], None
+    while True:
+        url = f"{route}?limit=2" + (f"&after={after}" if after else "")
+        response = client.get(url) if method == "GET" else client.post(url, json={"price": 1})
+        assert response.status_code == 200, response.get_data()
+        page = response.get_json()["data"]
+        items += page["items"]
+        after = page["next_cursor"]
+        if after is None:
+            return items
+
+@pytest.mark.parametrize("route, method, key", [
+    ("/posts/", "GET", "post_id"),
+    ("/posts/popular/", "POST", "post_id"),
+    ("/getUsers/", "GET", "user_id"),
+    ("/ratings/", "GET", "post_id")
+])
+def test_pages_cover_the_whole_list(client, make_user, make_post, route, method, key):
+    users = [make_user(f"user{i}") for i in range(3)]
+    posts = [make_post(users[0]) for _ in range(5)]
+    for i, post_id in enumerate(posts):
+        client.post(f"/post/{post_id}/overall/", json={"user_id": users[i % 3], "score": i})
+    items = walk(client, route, method)
+    whole = client.get(route) if method == "GET" else client.post(route, json={"price": 1})
+    # the unpaginated lists keep their older order, so only the contents are compared
+    assert sorted(i[key] for i in items) == sorted(i[key] for i in whole.get_json()["data"])
+    assert len(items) == len(whole.get_json()["data"]) > 2
+
+@pytest.mark.parametrize("after", [
+    cursor(["2020-01-01T00:00:00", {"a": 1}]),
+    cursor(["2020-01-01T00:00:00", "1"]),
+    cursor(["2020-01-01T00:00:00", True]),
+    cursor([1, 2]),
+    cursor(["2020-01-01T00:00:00"]),
+    cursor({"dateTime": "2020-01-01T00:00:00"}),
+    "not a cursor"
+])
+def test_tampered_cursor_is_rejected(client, make_user, make_post, after):
+    make_post(make_user("alice"))
+    response = client.get(f"/posts/?limit=2&after={after}")
+    assert response.status_code == 400, response.get_data()
+    assert response.get_json()["error"].startswith("Invalid cursor")
+
+def test_tampered_popularity_cursor_is_rejected(client):
+    response = client.post(f"/posts/popular/?limit=2&after={cursor(['high', 1])}", json={})
+    assert response.status_code == 400
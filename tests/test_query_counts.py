@@ -0,0 +1,59 @@
+import pytest
+
+# Each read route runs a fixed number of SQL statements, however many posts, follows, followers
+# and ratings the data has; a count that grows with the data is an N+1 query.
+
+
+def seed(client, make_user, make_post, follow, size):
+    users = [make_user(f"student{size}_{i}") for i in range(size)]
+    posts = [make_post(u, title=f"Recipe {p}", priceRating=1) for u in users for p in range(size)]
+    for other in users[1:]:
+        follow(users[0], other)
+        follow(other, users[0])
+    for u in users:
+        response = client.post(f"/post/{posts[0]}/overall/", json={"user_id": u, "score": 4})
+        assert response.status_code == 200, response.get_data()
+    return users, posts
+
+def countStatements(client, statements, method, path, body):
+    del statements[:]
+    response = client.open(path, method=method, json=body)
+    assert response.status_code == 200, response.get_data()
+    return len(statements)
+
+# name: (method, path, body, statements), where path and body are filled in from the seeded users
+# and posts. The feed checks the reader and their feed version (2), loads the reader (1), the
+# posts (1), and their comments and photos (2); the post and user routes read the version for the
+# ETag first.
+ROUTES = {
+    "feed": ("GET", "/user/{user}/following/posts/", None, 6),
+    "feed page": ("GET", "/user/{user}/following/posts/?limit=5", None, 6),
+    "post detail": ("GET", "/post/{post}/", None, 4),
+    "user profile": ("GET", "/user/{user}/", None, 7),
+    "users": ("GET", "/getUsers/", None, 6),
+    "users page": ("GET", "/getUsers/?limit=5", None, 6),
+    "users batch": ("POST", "/users/batch/", lambda users, posts: {"ids": users}, 6),
+    "posts": ("GET", "/posts/", None, 3),
+    "posts page": ("GET", "/posts/?limit=5", None, 3),
+    "posts batch": ("POST", "/posts/batch/", lambda users, posts: {"ids": posts}, 3),
+    "user posts": ("GET", "/user/{user}/posts/", None, 5),
+    "user posts page": ("GET", "/user/{user}/posts/?limit=5", None, 5),
+    "ratings": ("GET", "/ratings/", None, 1),
+    "ratings page": ("GET", "/ratings/?limit=5", None, 1),
+    "filter": ("POST", "/posts/filter/", lambda users, posts: {"price": 1}, 3),
+    "filter page": ("POST", "/posts/filter/?limit=5", lambda users, posts: {"price": 1}, 3),
+    "popular": ("POST", "/posts/popular/", lambda users, posts: {}, 3),
+    "popular page": ("POST", "/posts/popular/?limit=5", lambda users, posts: {}, 3),
+    "search": ("POST", "/posts/search/", lambda users, posts: {"query": "recipe"}, 3),
+    "cookable": ("POST", "/posts/cookable/", lambda users, posts: {"ingredients": ["rice", "egg"]}, 4),
+}
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_statements_per_route_are_fixed(client, statements, make_user, make_post, follow, route):
+    method, path, body, expected = ROUTES[route]
+    counts = []
+    for size in (2, 6):
+        users, posts = seed(client, make_user, make_post, follow, size)
+        counts.append(countStatements(client, statements, method, path.format(user=users[0], post=posts[0]),
+            body and body(users, posts)))
+    assert counts == [expected, expected]
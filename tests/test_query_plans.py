@@ -0,0 +1,12 @@
+from db import db
+import pytest
+
+
+# runs `flask check-query-plans`, so CI fails when a hot query falls back to a full table scan
+def test_no_full_table_scans(app):
+    with app.app_context():
+        if db.engine.dialect.name != "sqlite":
+            pytest.skip("check-query-plans reads SQLite plans")
+    result = app.test_cli_runner().invoke(args=["check-query-plans"])
+    assert result.exit_code == 0, result.output
+    assert "No full table scans" in result.output
@@ -0,0 +1,33 @@
+from db import db
+import database
+import pytest
+
+
+# a SQLite replica that only catches up when copyToReplicas() is called
+@pytest.fixture
+def laggingReplica(app, monkeypatch, tmp_path):
+    with app.app_context():
+        if db.engine.dialect.name != "sqlite":
+            pytest.skip("copyToReplicas copies SQLite databases only")
+    url = f"sqlite:///{tmp_path / 'replica.db'}"
+    monkeypatch.setitem(app.config, "SQLALCHEMY_REPLICAS", [url])
+    monkeypatch.setitem(app.config, "SQLALCHEMY_BINDS", {"replica0": url})
+    def catchUp():
+        with app.app_context():
+            assert database.copyToReplicas(app) == ["replica0"]
+    return catchUp
+
+# the write routes check that their user or post exists on the primary, so a write that depends
+# on the one before it succeeds even though the replica has not seen that one yet
+def test_dependent_writes_with_lagging_replica(client, make_user, make_post, follow, laggingReplica):
+    alice = make_user("alice")
+    laggingReplica()
+    bob = make_user("bob")
+    assert client.get(f"/user/{bob}/").status_code == 404 # reads still see the replica
+
+    follow(bob, alice)
+    assert client.post(f"/user/{bob}/unfollow/", json={"followed_user_id": alice}).status_code == 200
+    rated, deleted = make_post(bob), make_post(bob)
+    assert client.post(f"/post/{rated}/tag/", json={"tags": ["vegan"]}).status_code == 200
+    assert client.post(f"/post/{rated}/overall/", json={"user_id": alice, "score": 4}).status_code == 200
+    assert client.delete(f"/post/{deleted}/delete/").status_code == 200
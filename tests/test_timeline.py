@@ -0,0 +1,116 @@
+from db import db, timelines
+import pytest
+import timeline
+
+
+# runs the following feeds from the Timelines table, as TIMELINE_FANOUT=true does
+@pytest.fixture
+def fanout(app, monkeypatch):
+    monkeypatch.setitem(app.config, "TIMELINE_FANOUT", True)
+
+# holds background fan-outs until the test runs them
+class DeferredExecutor:
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, function, *args):
+        self.jobs.append((function, args))
+
+    def run(self):
+        for function, args in self.jobs:
+            function(*args)
+        self.jobs = []
+
+@pytest.fixture
+def deferred(monkeypatch):
+    executor = DeferredExecutor()
+    monkeypatch.setattr(timeline, "executor", executor)
+    return executor
+
+def feed(client, user_id, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get(f"/user/{user_id}/following/posts/", headers=headers)
+
+def feedIds(client, user_id):
+    return [p["post_id"] for p in feed(client, user_id).get_json()["data"]]
+
+# a feed read between the commit of a post and its background fan-out must not keep its ETag
+def test_background_fan_out_changes_feed_etag(client, monkeypatch, fanout, deferred, make_user, make_post, follow):
+    monkeypatch.setattr(timeline, "INLINE_FANOUT", 0) # every fan-out runs in the background
+    alice, bob = make_user("alice"), make_user("bob")
+    follow(bob, alice)
+    post_id = make_post(alice)
+    before = feed(client, bob)
+    assert before.get_json()["data"] == []
+
+    deferred.run()
+    assert feed(client, bob, before.headers["ETag"]).status_code == 200
+    after = feed(client, bob)
+    assert [p["post_id"] for p in after.get_json()["data"]] == [post_id]
+    assert after.headers["ETag"] != before.headers["ETag"]
+
+# the Timelines rows of user_id, newest first
+def timelineIds(app, user_id):
+    with app.app_context():
+        rows = db.session.query(timelines.c.postID).filter(timelines.c.userID == user_id) \
+            .order_by(timelines.c.dateTime.desc(), timelines.c.postID.desc())
+        return [post_id for post_id, in rows]
+
+def test_post_is_pushed_to_followers(app, client, fanout, make_user, make_post, follow):
+    alice, bob, carol = make_user("alice"), make_user("bob"), make_user("carol")
+    follow(bob, alice)
+    post_id = make_post(alice)
+    assert timelineIds(app, bob) == [post_id]
+    assert timelineIds(app, carol) == []
+    assert feedIds(client, bob) == [post_id]
+
+def test_timeline_keeps_newest_entries(app, monkeypatch, fanout, make_user, make_post, follow):
+    monkeypatch.setattr(timeline, "TIMELINE_SIZE", 3)
+    alice, bob = make_user("alice"), make_user("bob")
+    follow(bob, alice)
+    posts = [make_post(alice) for _ in range(5)]
+    assert timelineIds(app, bob) == posts[:1:-1]
+
+def test_follow_backfills_and_unfollow_prunes(app, client, monkeypatch, fanout, make_user, make_post, follow):
+    monkeypatch.setattr(timeline, "TIMELINE_SIZE", 3)
+    alice, bob, carol = make_user("alice"), make_user("bob"), make_user("carol")
+    posts = [make_post(alice) for _ in range(4)]
+    carolPost = make_post(carol)
+    follow(bob, alice)
+    follow(bob, carol)
+    # the newest three of both authors' posts
+    assert timelineIds(app, bob) == [carolPost, posts[3], posts[2]]
+    assert client.post(f"/user/{bob}/unfollow/", json={"followed_user_id": carol}).status_code == 200
+    assert timelineIds(app, bob) == [posts[3], posts[2]]
+    assert sorted(feedIds(client, bob)) == [posts[2], posts[3]]
+
+def test_rebuild_matches_fan_out(app, monkeypatch, fanout, make_user, make_post, follow):
+    alice, bob, carol = make_user("alice"), make_user("bob"), make_user("carol")
+    follow(bob, alice)
+    follow(carol, alice)
+    follow(carol, bob)
+    make_post(alice)
+    make_post(bob)
+    fannedOut = {u: timelineIds(app, u) for u in (alice, bob, carol)}
+    with app.app_context():
+        db.session.execute(timelines.delete())
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=["rebuild-timelines"])
+    assert result.exit_code == 0, result.output
+    assert {u: timelineIds(app, u) for u in (alice, bob, carol)} == fannedOut
+
+# authors with more than INLINE_FANOUT followers are fanned out in the background
+def test_large_fan_outs_run_in_background(app, monkeypatch, fanout, deferred, make_user, make_post, follow):
+    monkeypatch.setattr(timeline, "INLINE_FANOUT", 1)
+    alice, bob, carol = make_user("alice"), make_user("bob"), make_user("carol")
+    follow(bob, alice)
+    inline = make_post(alice)
+    assert deferred.jobs == []
+    assert timelineIds(app, bob) == [inline]
+
+    follow(carol, alice)
+    background = make_post(alice)
+    assert len(deferred.jobs) == 1
+    assert timelineIds(app, carol) == [inline]
+    deferred.run()
+    assert timelineIds(app, bob) == timelineIds(app, carol) == [background, inline]
@@ -0,0 +1,83 @@
+import datetime
+from db import db, Asset, AssetVariant
+from io import BytesIO
+from PIL import Image
+import time
+import uploads
+
+
+def addAsset(user_id, salt, status, created):
+    asset = Asset.__table__.insert().values(img_type="profile", profile_id=user_id, base_url="memory:/",
+        salt=salt, extension="png", width=1, height=1, status=status, created=created)
+    return db.session.execute(asset).inserted_primary_key[0]
+
+# a restart loses the bytes of queued uploads, so their assets would stay pending forever
+def test_fails_abandoned_uploads(app, client, make_user):
+    user_id = make_user("alice")
+    now = datetime.datetime.now()
+    hourAgo = now - datetime.timedelta(hours=1)
+    with app.app_context():
+        abandoned = addAsset(user_id, "a", "pending", hourAgo)
+        unrecorded = addAsset(user_id, "b", "pending", None)
+        running = addAsset(user_id, "c", "pending", now)
+        ready = addAsset(user_id, "d", "ready", hourAgo)
+        db.session.commit()
+        assert uploads.failAbandoned(now) == 2
+
+    statuses = {i: client.get(f"/image/{i}/").get_json()["data"]["status"] for i in (abandoned, unrecorded, running, ready)}
+    assert statuses == {abandoned: "failed", unrecorded: "failed", running: "pending", ready: "ready"}
+
+def png():
+    out = BytesIO()
+    Image.new("RGB", (4, 4), "red").save(out, format="PNG")
+    return out.getvalue()
+
+def upload(client, user_id, body):
+    response = client.post(f"/user/image/upload/stream/?imgType=profile&typeId={user_id}",
+        data=body, content_type="image/png")
+    assert response.status_code == 202, response.get_data()
+    return response.get_json()["data"]
+
+# waits for the background upload and its variants
+def stored(client, img_id):
+    for _ in range(300):
+        image = client.get(f"/image/{img_id}/").get_json()["data"]
+        if image["status"] != "pending" and image["variants"]:
+            return image
+        time.sleep(0.1)
+    raise AssertionError(f"image {img_id} was not stored")
+
+# the stored object of an image is shared by its duplicates and removed with the last of them
+def test_duplicates_share_stored_object(app, client, make_user):
+    user_id = make_user("alice")
+    objects = app.extensions["storage"].objects
+    first = stored(client, upload(client, user_id, png())["image_id"])
+    assert first["status"] == "ready"
+    keys = {first["url"].rsplit("/", 1)[1]} | {v["url"].rsplit("/", 1)[1] for v in first["variants"].values()}
+
+    second = upload(client, user_id, png())
+    assert second["status"] == "ready" and second["url"] == first["url"]
+    assert client.delete(f"/image/{first['image_id']}/delete/").status_code == 200
+    assert keys <= set(objects)
+
+    assert client.delete(f"/image/{second['image_id']}/delete/").status_code == 200
+    assert not keys & set(objects)
+    with app.app_context():
+        assert AssetVariant.query.count() == 0
+
+    # a deleted object is uploaded again instead of being reused
+    third = upload(client, user_id, png())
+    assert third["status"] == "pending"
+    assert stored(client, third["image_id"])["status"] == "ready"
+
+# a form-urlencoded body would be parsed as a form, losing the image
+def test_raw_upload_needs_image_content_type(client, make_user):
+    user_id = make_user("alice")
+    response = client.post(f"/user/image/upload/stream/?imgType=profile&typeId={user_id}",
+        data=png(), content_type="application/x-www-form-urlencoded")
+    assert response.status_code == 415
+    assert "application/x-www-form-urlencoded" in response.get_json()["error"]
+    response = client.post(f"/user/image/upload/stream/?imgType=profile&typeId={user_id}",
+        data=png(), content_type="application/octet-stream")
+    assert response.status_code == 202
+    stored(client, response.get_json()["data"]["image_id"])